@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import time
+import random
+import multiprocessing
+import numpy as np
+import utils as u
+import pure_arbitrage as pa
+import order_store as ost
+import metadata as md
+import metrics
+import argparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARK_DIR = "./benchmark"
+PACKAGED_VOLUMES = [0.01, 0.1, 1, 5, 10, 20, 100, 1000]
+ORDER_RANGES = ["station", "solarsystem", "region", "1", "5", "10"]
+
+
+def generate(path=BENCHMARK_DIR, num_items=1000, num_regions=5, orders_per_side=20, num_systems=200, price_distribution="lognormal", price_spread=0.3, seed=1):
+    # Writes orders, lookups and metadata in the same ./data layout ESI downloads are saved in, so the pipeline runs without a connection
+    rng = np.random.RandomState(seed)
+    for folder in ["data/orders", "data/regions", "data/routes", "data/systems", "data/types", "output"]:
+        if not os.path.isdir(os.path.join(path, folder)):
+            os.makedirs(os.path.join(path, folder))
+
+    regions = [10000001 + k for k in range(num_regions)]
+    region_names = [pa.SAFE_REGIONS[k] if k < len(pa.SAFE_REGIONS) else "Bench Region " + str(k) for k in range(num_regions)]
+    systems = [30000001 + k for k in range(num_systems)]
+    system_names = ["Bench System " + str(k) for k in range(num_systems)]
+    types = [1001 + k for k in range(num_items)]
+    type_names = ["Bench Item " + str(k) for k in range(num_items)]
+    _write_lookup(path, "regions", regions, region_names, "region")
+    _write_lookup(path, "systems", systems, system_names, "solar_system")
+    _write_lookup(path, "types", types, type_names, "inventory_type")
+
+    # A random spanning tree plus a few shortcuts keeps every system reachable
+    jumps = [(systems[k], systems[rng.randint(k)]) for k in range(1, num_systems)]
+    jumps += [tuple(rng.choice(systems, 2, replace=False).tolist()) for k in range(num_systems//4)]
+    stargates = {}
+    stargates_by_system = {system_id: [] for system_id in systems}
+    for origin, destination in jumps:
+        for system_id, other in [(origin, destination), (destination, origin)]:
+            stargate = 50000001 + len(stargates)
+            stargates[stargate] = {"stargate_id": stargate, "system_id": system_id, "destination": {"system_id": other}}
+            stargates_by_system[system_id].append(stargate)
+
+    num_constellations = max(1, num_systems//8)
+    security = np.round(rng.uniform(-1, 1, num_systems), 3).tolist()
+    store = md.MetadataStore(os.path.join(path, "data/metadata.db"))
+    store.put_many("systems", {system_id: {
+        "system_id": system_id,
+        "name": system_names[k],
+        "security_status": security[k],
+        "constellation_id": 20000001 + k % num_constellations,
+        "stargates": stargates_by_system[system_id]
+    } for k, system_id in enumerate(systems)})
+    store.put_many("stargates", stargates)
+    store.put_many("constellations", {20000001 + k: {
+        "constellation_id": 20000001 + k,
+        "region_id": regions[k % num_regions]
+    } for k in range(num_constellations)})
+    store.put_many("types", {type_id: {
+        "type_id": type_id,
+        "name": type_names[k],
+        "packaged_volume": PACKAGED_VOLUMES[rng.randint(len(PACKAGED_VOLUMES))]
+    } for k, type_id in enumerate(types)})
+
+    # Buys are centred a little below each item's base price and sells a little above, so only the tails cross
+    base_prices = np.exp(rng.normal(np.log(1000), 2, num_items))
+    num_orders = 0
+    for region, region_name in zip(regions, region_names):
+        orders = []
+        for is_buy_order in [True, False]:
+            type_id = np.repeat(types, orders_per_side)
+            centre = np.repeat(base_prices, orders_per_side)*(1 - price_spread/2 if is_buy_order else 1 + price_spread/2)
+            if price_distribution == "uniform":
+                price = centre*rng.uniform(1 - price_spread, 1 + price_spread, len(type_id))
+            else:
+                price = centre*np.exp(rng.normal(0, price_spread, len(type_id)))
+            price = np.maximum(np.round(price, 2), 0.01).tolist()
+            system_id = rng.choice(systems, len(type_id)).tolist()
+            volume_total = rng.randint(1, 1000000, len(type_id)).tolist()
+            volume_remain = [rng.randint(1, total + 1) for total in volume_total]
+            for k in range(len(type_id)):
+                num_orders += 1
+                orders.append({
+                    "order_id": 5000000000 + num_orders,
+                    "type_id": int(type_id[k]),
+                    "location_id": 60000000 + system_id[k] % 1000000,
+                    "system_id": system_id[k],
+                    "is_buy_order": is_buy_order,
+                    "price": price[k],
+                    "volume_remain": volume_remain[k],
+                    "volume_total": volume_total[k],
+                    "min_volume": 1,
+                    "duration": 90,
+                    "issued": "2018-06-01T12:00:00Z",
+                    "range": ORDER_RANGES[rng.randint(len(ORDER_RANGES))]
+                })
+        random.Random(seed + region).shuffle(orders)
+        with open(os.path.join(path, "data/orders", region_name + ".json"), "w") as f:
+            json.dump(orders, f)
+    return num_orders
+
+
+def _write_lookup(path, type, ids, names, category):
+    with open(os.path.join(path, "data", type, type + ".json"), "w") as f:
+        json.dump(ids, f)
+    with open(os.path.join(path, "data", type, type + "_names.json"), "w") as f:
+        json.dump([{"id": id, "name": name, "category": category} for id, name in zip(ids, names)], f)
+
+
+def get_peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak/(1024.0*1024.0) if sys.platform == "darwin" else peak/1024.0
+
+
+def quietly(verbose, function, *args):
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        return function(*args)
+    finally:
+        if not verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+
+def time_stage(report, name, unit, count_of, verbose, function, *args):
+    start = time.time()
+    result = quietly(verbose, function, *args)
+    seconds = time.time() - start
+    count = count_of(result)
+    report[name] = {
+        "seconds": seconds,
+        "count": count,
+        "unit": unit,
+        "per_second": count/seconds if seconds > 0 else None,
+        "peak_memory_mb": get_peak_memory_mb()
+    }
+    print(name.ljust(12) + ("%.3fs" % seconds).rjust(10) + (str(count) + " " + unit).rjust(22) + ("%.0f/s" % report[name]["per_second"] if report[name]["per_second"] else "-").rjust(14) + ("%.1fMB" % report[name]["peak_memory_mb"] if report[name]["peak_memory_mb"] else "-").rjust(12))
+    return result
+
+
+def run_benchmark(path=BENCHMARK_DIR, engine="vectorized", workers=1, mode="pairs", min_margin=30, max_item_purchase_price=1000000, min_potential_revenue=5000000, min_system_sec_rating=0.5, cargo_capacity=6000, best_price_queries=1000, verbose=False):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        report = {}
+        metrics.reset()
+        print("stage".ljust(12) + "time".rjust(10) + "processed".rjust(22) + "throughput".rjust(14) + "peak mem".rjust(12))
+
+        # Always built from the saved region files, so the store from a previous run doesn't count
+        if ost.store_exists():
+            ost.write_columns({name: np.empty(0, dtype=dtype) for name, dtype in ost.COLUMNS})
+        time_stage(report, "load", "orders", lambda changed: len(ost.OrderStore()), verbose, pa.get_and_save_orders, False, False, False)
+        store = ost.OrderStore()
+        lookups = quietly(verbose, pa.get_name_lookups)
+        systems = quietly(verbose, pa.get_system_index, lookups["systems"])
+
+        def group():
+            return [store.book(type_id, pa.ORDER_COLUMNS) for type_id in store.type_ids.tolist()]
+        time_stage(report, "group", "orders", lambda books: len(store), verbose, group)
+
+        rows = time_stage(report, "scan", "orders", lambda rows: len(store), verbose, pa.scan_store,
+                          store, engine, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, workers, mode)
+        report["scan"]["opportunities"] = len(rows)
+
+        header, rows = time_stage(report, "enrich", "opportunities", lambda result: len(rows), verbose, pa.add_opportunity_details,
+                                  rows, lookups, systems, min_potential_revenue, True, cargo_capacity, False, "local", u.DEFAULT_CONCURRENCY, mode)
+
+        od_pairs = list(set([(row["_buy_system"], row["_sell_system"], row["buy_in_system_name"], row["sell_in_system_name"]) for row in rows]))
+        route_by_od_pair = time_stage(report, "route", "od pairs", len, verbose, pa.get_local_routes_by_od_pairs, od_pairs, systems)
+        header += ["route", "route_jumps"]
+        for row in rows:
+            route = route_by_od_pair[(row["_buy_system"], row["_sell_system"], row["buy_in_system_name"], row["sell_in_system_name"])]
+            row["route"] = '-'.join([str(i) for i in route])
+            row["route_jumps"] = len(route)
+
+        time_stage(report, "write", "rows", lambda result: len(rows), verbose, u.write_to_csv, header, rows, "./output/pure_arbitrage.csv")
+
+        import best_item_price as bip
+        import price_index as pi
+        index, lookups = time_stage(report, "price_index", "orders", lambda result: len(result[0]), verbose, bip.load_price_index, False, False)
+        item_names = [lookups["types"][str(type_id)] for type_id in store.type_ids.tolist()]
+        def best_prices():
+            for k in range(best_price_queries):
+                bip.get_best_item_price(item_names[k % len(item_names)], "Sell", 1, False, False, index=index, lookups=lookups)
+            return range(best_price_queries)
+        time_stage(report, "best_price", "queries", len, verbose, best_prices)
+
+        queries = [{"item_name": item_name, "side": side, "quantity": 1000} for item_name in item_names for side in ["Buy", "Sell"]]
+        time_stage(report, "best_batch", "queries", len, verbose, pi.best_many, index, queries, bip.get_type_id_by_name(lookups))
+        time_stage(report, "fill_batch", "queries", len, verbose, pi.fill_many, index, queries, bip.get_type_id_by_name(lookups))
+        # Counters and call timings collected along the way, e.g. how many order pairs the scan checked against how many it kept
+        report["metrics"] = metrics.snapshot()
+        return report
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--path', default=BENCHMARK_DIR, type=str, help='Default ' + BENCHMARK_DIR + '. Folder the synthetic data is generated in and the benchmark runs against')
+    parser.add_argument('--generate', type=u.str2bool, nargs="?", const=True, default=True, help='Default True. If True, generates new synthetic data before running. Set to False to rerun against the same data')
+    parser.add_argument('--items', default=1000, type=int, help='Default 1000. Number of items with orders')
+    parser.add_argument('--regions', default=5, type=int, help='Default 5. Number of regions with orders')
+    parser.add_argument('--orders_per_side', default=20, type=int, help='Default 20. Number of buy orders and of sell orders per item per region')
+    parser.add_argument('--systems', default=200, type=int, help='Default 200. Number of systems orders are spread across')
+    parser.add_argument('--price_distribution', default="lognormal", choices=["lognormal", "uniform"], help='Default lognormal. Distribution of order prices around each item\'s base price')
+    parser.add_argument('--price_spread', default=0.3, type=float, help='Default 0.3. Relative width of the price distribution. Wider spreads give more opportunities')
+    parser.add_argument('--seed', default=1, type=int, help='Default 1. Random seed for the synthetic data')
+    parser.add_argument('--engine', default="vectorized", choices=["vectorized", "legacy"], help='Default vectorized. The arbitrage scan to benchmark')
+    parser.add_argument('--workers', default=1, type=int, help='Default 1. Number of processes to split the arbitrage scan across')
+    parser.add_argument('--mode', default="pairs", choices=["pairs", "depth"], help='Default pairs. The arbitrage scan mode to benchmark')
+    parser.add_argument('--min_margin', default=30, type=float, help='Default 30. Scan parameter, as for get_pure_arbitrage.py')
+    parser.add_argument('--max_item_purchase_price', default=1000000, type=float, help='Default 1000000. Scan parameter, as for get_pure_arbitrage.py')
+    parser.add_argument('--min_potential_revenue', default=5000000, type=float, help='Default 5000000. Scan parameter, as for get_pure_arbitrage.py')
+    parser.add_argument('--min_system_sec_rating', default=0.5, type=float, help='Default 0.5. Scan parameter, as for get_pure_arbitrage.py')
+    parser.add_argument('--cargo_capacity', default=6000, type=float, help='Default 6000. Cargo capacity used when enriching opportunities')
+    parser.add_argument('--best_price_queries', default=1000, type=int, help='Default 1000. Number of single best item price lookups to time. Batch lookups are timed for every item')
+    parser.add_argument('--output', default=None, type=str, help='If given, the timings are also saved to this JSON file')
+    parser.add_argument('--verbose', type=u.str2bool, nargs="?", const=True, default=False, help='Default False. If True, shows the normal progress output of each stage')
+    args = parser.parse_args()
+
+    if args.generate:
+        print("Generating synthetic orders in " + args.path)
+        # Generated in a separate process so it doesn't count towards the benchmark's peak memory
+        pool = multiprocessing.Pool(1)
+        num_orders = pool.apply(generate, (args.path, args.items, args.regions, args.orders_per_side, args.systems, args.price_distribution, args.price_spread, args.seed))
+        pool.close()
+        pool.join()
+        print("Generated " + str(num_orders) + " orders\n")
+    report = run_benchmark(args.path, args.engine, args.workers, args.mode, args.min_margin, args.max_item_purchase_price, args.min_potential_revenue, args.min_system_sec_rating, args.cargo_capacity, args.best_price_queries, args.verbose)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
@@ -1,63 +1,76 @@
-import json
-import requests
-import csv
-import pandas as pd
-import sys
 import utils as u
 import argparse
 import pure_arbitrage as pa
+import price_index as pi
 
-def get_best_item_price(item_name, side="Buy", quantity=1, safe_regions=True, get_new_orders=True):
 
-    if side == "Buy":
-        is_buy_order = True
-    elif side == "Sell":
-        is_buy_order = False
-    else:
-        print "Unrecognised side. Please select 'Buy' or 'Sell'"
-        return
+def load_price_index(safe_regions=True, get_new_orders=True, concurrency=u.DEFAULT_CONCURRENCY):
+    lookups = pa.get_name_lookups()
+    store = pa.load_order_store(get_new_orders, safe_regions, concurrency)
+    regions = None
+    if safe_regions:
+        regions = [int(region) for region, region_name in lookups["regions"].items() if region_name in pa.SAFE_REGIONS]
+    print("\nIndexing prices for " + str(len(store)) + " orders")
+    return pi.PriceIndex(store, regions), lookups
 
-    if get_new_orders:
-        pa.get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions)
-        df = pd.read_csv("./data/orders/orders.csv", quotechar="|")
-    else:
-        try:
-            print "Loading orders CSV... This might take a minute"
-            df = pd.read_csv("./data/orders/orders.csv", quotechar="|")
-        except IOError:
-            print("No order data saved, but 'get_new_orders' parameter was set to False. Downloading anyway")
-            pa.get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions)
-            df = pd.read_csv("./data/orders/orders.csv", quotechar="|")
 
-    print "Getting best " + side + " price for " + item_name
+def get_type_id_by_name(lookups):
+    if "type_id_by_name" not in lookups:
+        lookups["type_id_by_name"] = u.load_compiled(
+            "./data/types/types_names.json",
+            lambda: {type_name: int(type_id) for type_id, type_name in lookups["types"].items()},
+            "type_id_by_name"
+        )
+    return lookups["type_id_by_name"]
 
-    if safe_regions:
-        df = df[df["region_name"].isin(pa.SAFE_REGIONS)]
 
-    orders = df[
-        (df["type_name"] == item_name) &
-        (df["is_buy_order"] == is_buy_order) &
-        (df["volume_remain"] >= quantity)
-    ]
+def get_best_item_price(item_name, side="Buy", quantity=1, safe_regions=True, get_new_orders=True, concurrency=u.DEFAULT_CONCURRENCY, index=None, lookups=None):
 
-    if orders.empty:
-        print "No orders matching that item name, side and quantity combination"
+    if side not in ["Buy", "Sell"]:
+        print("Unrecognised side. Please select 'Buy' or 'Sell'")
         return
 
-    if side == "Buy":
-        print orders.ix[orders["price"].idxmax()]
-    else:
-        print orders.ix[orders["price"].idxmin()]
+    if index is None:
+        index, lookups = load_price_index(safe_regions, get_new_orders, concurrency)
+
+    print("Getting best " + side + " price for " + item_name)
+
+    type_id = get_type_id_by_name(lookups).get(item_name)
+    order = index.best(type_id, pi.get_is_buy_order(side), quantity) if type_id is not None else None
+    if order is None:
+        print("No orders matching that item name, side and quantity combination")
+        return
+
+    order["region_name"] = lookups["regions"][str(order["region"])]
+    order["system_name"] = lookups["systems"][str(order["system_id"])]
+    order["type_name"] = lookups["types"][str(order["type_id"])]
+    for name in sorted(order.keys()):
+        print(name.ljust(16) + str(order[name]))
+
+    return order
+
+
+def get_best_item_prices(item_names, side="Buy", quantity=1, safe_regions=True, get_new_orders=True, concurrency=u.DEFAULT_CONCURRENCY):
+    # Prices a whole list of items in one pass over the index. Returns None for items without a matching order
+    index, lookups = load_price_index(safe_regions, get_new_orders, concurrency)
+    queries = [{"item_name": item_name, "side": side, "quantity": quantity} for item_name in item_names]
+    return dict(zip(item_names, pi.best_many(index, queries, get_type_id_by_name(lookups))))
 
-    return
 
 if __name__ == "__main__":
     parser=argparse.ArgumentParser()
     parser.add_argument('--item_name', type=str, help='Item name')
     parser.add_argument('--side', default="Buy", type=str, help='"Buy" or "Sell"')
     parser.add_argument('--quantity', default=1, type=int, help='Amount that needs to be available to consider the price')
-    parser.add_argument('--get_new_orders', type=u.str2bool, nargs="?", const=False, default=False, help='If True, downloads new orders and saves them to the filesystem prior to finding arbitrage opportunities. Can take ~1h')
+    parser.add_argument('--get_new_orders', type=u.str2bool, nargs="?", const=False, default=False, help='If True, downloads new orders and saves them to the filesystem prior to finding arbitrage opportunities. Pages are fetched --concurrency at a time and regions still in the ESI cache are skipped')
     parser.add_argument('--safe_regions', type=u.str2bool, nargs="?", const=True, default=True, help='Default True. Used in conjunction with get_new_orders. If True, only downloads results from regions in Cal/Gal/Min/Amarr space. See code for list.')
+    parser.add_argument('--concurrency', default=u.DEFAULT_CONCURRENCY, type=int, help='Default ' + str(u.DEFAULT_CONCURRENCY) + '. Max number of ESI requests in flight at once when downloading orders')
+    parser.add_argument('--serve', type=u.str2bool, nargs="?", const=True, default=False, help='Default False. If True, keeps the price index loaded and answers best price and fill cost queries over HTTP instead of pricing one item')
+    parser.add_argument('--port', default=pi.DEFAULT_PORT, type=int, help='Default ' + str(pi.DEFAULT_PORT) + '. Port to serve on when --serve is True')
     args = parser.parse_args()
 
-    get_best_item_price(item_name=args.item_name, side=args.side, quantity=args.quantity, get_new_orders=args.get_new_orders, safe_regions=args.safe_regions)
+    if args.serve:
+        index, lookups = load_price_index(args.safe_regions, args.get_new_orders, args.concurrency)
+        pi.serve(index, get_type_id_by_name(lookups), port=args.port)
+    else:
+        get_best_item_price(item_name=args.item_name, side=args.side, quantity=args.quantity, get_new_orders=args.get_new_orders, safe_regions=args.safe_regions, concurrency=args.concurrency)
@@ -0,0 +1,76 @@
+import numpy as np
+
+HAUL_HEADER = [
+    "buy_in_system_name",
+    "sell_in_system_name",
+    "jumps",
+    "num_items",
+    "cargo_volume",
+    "cost",
+    "profit",
+    "isk_per_jump",
+    "items"
+]
+
+
+def get_jumps_by_od_pair(graph, od_pairs):
+    # Jumps between every (origin, destination) system pair from one search over all the origins at once, along the
+    # same routes --get_routes picks: through high sec where there is a way, the shortest route otherwise. -1 where there isn't one
+    origin_ids = sorted(set(origin_id for origin_id, destination_id in od_pairs))
+    row_by_origin = {origin_id: k for k, origin_id in enumerate(origin_ids)}
+    matrix = graph.distances(origin_ids, secure=True)
+    matrix = np.where(matrix >= 0, matrix, graph.distances(origin_ids))
+    rows = [row_by_origin[origin_id] for origin_id, destination_id in od_pairs]
+    jumps = matrix[rows, graph.index_of([destination_id for origin_id, destination_id in od_pairs])]
+    return dict(zip(od_pairs, jumps.tolist()))
+
+
+def fill_cargo(rows, cargo_capacity=0):
+    # Most profit per m3 first, until the hold is full. One row per item, since two rows for the same item
+    # between the same systems would be selling into the same buy orders. With no cargo_capacity everything fits
+    cargo = []
+    space = float(cargo_capacity)
+    seen = set()
+    for row in sorted(rows, key=lambda row: (-(row["sell_price"] - row["buy_price"]) / row["item_volume"], row["item_id"])):
+        if row["item_id"] in seen:
+            continue
+        quantity = row["amount_available_to_buy"]
+        if cargo_capacity > 0:
+            quantity = min(quantity, int(space // row["item_volume"]))
+        if quantity <= 0:
+            continue
+        seen.add(row["item_id"])
+        cargo.append((row, quantity))
+        space -= quantity*row["item_volume"]
+    return cargo
+
+
+def get_hauls(rows, jumps_by_od_pair, cargo_capacity=0, min_potential_revenue=0, max_jumps=0):
+    # One haul per buy/sell system pair, carrying every item worth trading between them.
+    # Prices are each row's averages, so a part filled row is valued a little low, never high
+    rows_by_od_pair = {}
+    for row in rows:
+        rows_by_od_pair.setdefault((row["_buy_system"], row["_sell_system"]), []).append(row)
+
+    hauls = []
+    for od_pair, pair_rows in rows_by_od_pair.items():
+        jumps = jumps_by_od_pair[od_pair]
+        if jumps < 0 or (max_jumps > 0 and jumps > max_jumps):
+            continue
+        cargo = fill_cargo(pair_rows, cargo_capacity)
+        profit = sum([(row["sell_price"] - row["buy_price"])*quantity for row, quantity in cargo])
+        if len(cargo) == 0 or profit <= min_potential_revenue:
+            continue
+        hauls.append({
+            "buy_in_system_name": pair_rows[0]["buy_in_system_name"],
+            "sell_in_system_name": pair_rows[0]["sell_in_system_name"],
+            "jumps": jumps,
+            "num_items": len(cargo),
+            "cargo_volume": sum([quantity*row["item_volume"] for row, quantity in cargo]),
+            "cost": sum([quantity*row["buy_price"] for row, quantity in cargo]),
+            "profit": profit,
+            "isk_per_jump": profit / max(jumps, 1),
+            "items": "; ".join([row["item"] + " x" + str(quantity) + " " + str(row["buy_in_location_id"]) + "->" + str(row["sell_in_location_id"]) for row, quantity in cargo])
+        })
+    hauls.sort(key=lambda haul: (-haul["isk_per_jump"], haul["buy_in_system_name"], haul["sell_in_system_name"]))
+    return hauls
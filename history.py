@@ -0,0 +1,287 @@
+import json
+import os
+import time
+import numpy as np
+import utils as u
+import order_store as ost
+import argparse
+
+HISTORY_DIR = "./data/orders/history"
+RESTORED_DIR = "./data/orders/restored"
+
+# The most recent snapshot, uncompressed, so the next one can be diffed against it without replaying deltas
+LATEST_FILE = "latest.npz"
+
+# A full copy is saved every this many snapshots, so rebuilding any point in time only replays a few deltas
+KEYFRAME_INTERVAL = 24
+
+# Columns an order can change without becoming a new order. A change to anything else is saved as the order being removed and added again
+CHANGING_COLUMNS = ["price", "volume_remain", "issued"]
+
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+SERIES_HEADER = ["time", "snapshot", "best_buy", "best_sell", "buy_volume", "sell_volume", "buy_orders", "sell_orders"]
+
+
+def load_index(path=HISTORY_DIR):
+    fileloc = os.path.join(path, "index.json")
+    if not os.path.isfile(fileloc):
+        return []
+    with open(fileloc) as f:
+        return json.load(f)
+
+
+def save_index(index, path=HISTORY_DIR):
+    fileloc = os.path.join(path, "index.json")
+    with open(fileloc + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.rename(fileloc + ".tmp", fileloc)
+
+
+def get_columns(store):
+    # The whole store sorted by order_id. An order seen twice (ESI pages can shift mid download) is only kept once
+    order_id = np.asarray(store.column("order_id"))
+    order_id, order = np.unique(order_id, return_index=True)
+    return {name: np.asarray(store.column(name))[order] for name, dtype in ost.COLUMNS}
+
+
+def get_delta(old, new):
+    # Both sorted by order_id
+    removed = ~np.isin(old["order_id"], new["order_id"], assume_unique=True)
+    added = ~np.isin(new["order_id"], old["order_id"], assume_unique=True)
+    both = np.flatnonzero(~added)
+    replaced = np.zeros(len(both), dtype=bool)
+    changed = np.zeros(len(both), dtype=bool)
+    for name, dtype in ost.COLUMNS:
+        differs = old[name][~removed] != new[name][both]
+        if name in CHANGING_COLUMNS:
+            changed |= differs
+        else:
+            replaced |= differs
+    changed &= ~replaced
+    added[both[replaced]] = True
+
+    delta = {"removed": np.concatenate((old["order_id"][removed], new["order_id"][both[replaced]]))}
+    for name, dtype in ost.COLUMNS:
+        delta["added_" + name] = new[name][added]
+    delta["changed_order_id"] = new["order_id"][both[changed]]
+    for name in CHANGING_COLUMNS:
+        delta["changed_" + name] = new[name][both[changed]]
+    return delta
+
+
+def apply_delta(columns, delta, type_ids=None):
+    # With type_ids, columns only hold those items and only their part of the delta is applied
+    keep = ~np.isin(columns["order_id"], delta["removed"])
+    columns = {name: values[keep] for name, values in columns.items()}
+
+    changed_order_id = delta["changed_order_id"]
+    positions = np.minimum(np.searchsorted(columns["order_id"], changed_order_id), max(len(columns["order_id"]) - 1, 0))
+    present = (columns["order_id"][positions] == changed_order_id) if len(columns["order_id"]) > 0 else np.zeros(len(changed_order_id), dtype=bool)
+    for name in CHANGING_COLUMNS:
+        columns[name][positions[present]] = delta["changed_" + name][present]
+
+    added = np.ones(len(delta["added_order_id"]), dtype=bool) if type_ids is None else np.isin(delta["added_type_id"], type_ids)
+    if added.any():
+        columns = {name: np.concatenate((values, delta["added_" + name][added])) for name, values in columns.items()}
+        order = np.argsort(columns["order_id"], kind="mergesort")
+        columns = {name: values[order] for name, values in columns.items()}
+    return columns
+
+
+def load_snapshot_file(entry, path=HISTORY_DIR):
+    with np.load(os.path.join(path, entry["file"])) as data:
+        return {name: data[name] for name in data.files}
+
+
+def load_keyframe(entry, path=HISTORY_DIR, type_ids=None):
+    columns = load_snapshot_file(entry, path)
+    if type_ids is not None:
+        keep = np.isin(columns["type_id"], type_ids)
+        columns = {name: values[keep] for name, values in columns.items()}
+    return columns
+
+
+def replay(index, first, last, type_ids=None, path=HISTORY_DIR):
+    # Yields (entry, columns) for snapshots first to last, replaying deltas forward from the keyframe at or before first
+    keyframe = max(k for k in range(first + 1) if index[k]["keyframe"])
+    columns = None
+    for k in range(keyframe, last + 1):
+        if index[k]["keyframe"]:
+            columns = load_keyframe(index[k], path, type_ids)
+        else:
+            columns = apply_delta(columns, load_snapshot_file(index[k], path), type_ids)
+        if k >= first:
+            yield index[k], columns
+
+
+def iter_snapshots(start=None, end=None, type_ids=None, path=HISTORY_DIR):
+    # Every snapshot taken between start and end
+    index = load_index(path)
+    positions = [k for k, entry in enumerate(index) if (start is None or entry["time"] >= start) and (end is None or entry["time"] <= end)]
+    if len(positions) == 0:
+        return iter([])
+    return replay(index, positions[0], positions[-1], type_ids, path)
+
+
+def get_position(as_of, index):
+    positions = [k for k, entry in enumerate(index) if entry["time"] <= as_of]
+    if len(positions) == 0:
+        raise ValueError("No order snapshot saved at or before " + format_time(as_of))
+    return positions[-1]
+
+
+def get_snapshot(as_of=None, type_ids=None, path=HISTORY_DIR):
+    index = load_index(path)
+    if len(index) == 0:
+        raise ValueError("No order snapshots saved in " + path)
+    position = len(index) - 1 if as_of is None else get_position(as_of, index)
+    for entry, columns in replay(index, position, position, type_ids, path):
+        return columns
+
+
+def get_next_file(index):
+    # Numbered on from the last snapshot rather than by position, since old ones may have been pruned
+    number = int(index[-1]["file"][len("snapshot_"):-len(".npz")]) + 1 if len(index) > 0 else 0
+    return "snapshot_%06d.npz" % number
+
+
+def load_latest(index, path=HISTORY_DIR):
+    fileloc = os.path.join(path, LATEST_FILE)
+    if os.path.isfile(fileloc):
+        with np.load(fileloc) as data:
+            if ost.to_python(data["snapshot"].item()) == index[-1]["file"]:
+                return {name: data[name] for name, dtype in ost.COLUMNS}
+    return get_snapshot(path=path)
+
+
+def save_latest(columns, entry, path=HISTORY_DIR):
+    fileloc = os.path.join(path, LATEST_FILE)
+    np.savez(fileloc + ".tmp.npz", snapshot=entry["file"], **columns)
+    os.rename(fileloc + ".tmp.npz", fileloc)
+
+
+def prune(index, oldest, path=HISTORY_DIR):
+    # Drops snapshots taken before oldest, apart from the keyframe the first one kept is replayed from
+    kept = [k for k, entry in enumerate(index) if entry["time"] >= oldest]
+    first = kept[0] if len(kept) > 0 else len(index) - 1
+    first = max(k for k in range(first + 1) if index[k]["keyframe"])
+    for entry in index[:first]:
+        os.remove(os.path.join(path, entry["file"]))
+    return index[first:]
+
+
+def record(store, path=HISTORY_DIR, snapshot_time=None, keep_days=0):
+    # Saves the store as the next snapshot. Usually a delta on the one before, every KEYFRAME_INTERVAL'th a full copy.
+    # With keep_days, snapshots older than that are deleted
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    snapshot_time = time.time() if snapshot_time is None else snapshot_time
+    index = load_index(path)
+    columns = get_columns(store)
+    entry = {
+        "time": snapshot_time,
+        "file": get_next_file(index),
+        "num_orders": len(columns["order_id"])
+    }
+
+    keyframes = [k for k, previous in enumerate(index) if previous["keyframe"]]
+    entry["keyframe"] = len(keyframes) == 0 or len(index) - keyframes[-1] >= KEYFRAME_INTERVAL
+    if entry["keyframe"]:
+        data = columns
+    else:
+        data = get_delta(load_latest(index, path), columns)
+        entry["removed"] = len(data["removed"])
+        entry["added"] = len(data["added_order_id"])
+        entry["changed"] = len(data["changed_order_id"])
+    np.savez_compressed(os.path.join(path, entry["file"]), **data)
+    entry["bytes"] = os.path.getsize(os.path.join(path, entry["file"]))
+
+    index.append(entry)
+    if keep_days > 0:
+        index = prune(index, snapshot_time - keep_days*24*60*60, path)
+    save_index(index, path)
+    save_latest(columns, entry, path)
+    return entry
+
+
+def restore(as_of, path=HISTORY_DIR, store_path=RESTORED_DIR):
+    # Writes the snapshot as of a point in time out as an order store of its own, so it can be scanned like the current one
+    columns = get_snapshot(as_of, path=path)
+    ost.write_columns(columns, store_path)
+    return ost.OrderStore(store_path)
+
+
+def get_price_series(type_id, regions=None, start=None, end=None, path=HISTORY_DIR):
+    series = []
+    for entry, columns in iter_snapshots(start, end, [type_id], path):
+        keep = np.ones(len(columns["order_id"]), dtype=bool) if regions is None else np.isin(columns["region"], regions)
+        is_buy_order = columns["is_buy_order"][keep]
+        price = columns["price"][keep]
+        volume = columns["volume_remain"][keep]
+        series.append({
+            "time": format_time(entry["time"]),
+            "snapshot": entry["file"],
+            "best_buy": float(price[is_buy_order].max()) if is_buy_order.any() else None,
+            "best_sell": float(price[~is_buy_order].min()) if (~is_buy_order).any() else None,
+            "buy_volume": int(volume[is_buy_order].sum()),
+            "sell_volume": int(volume[~is_buy_order].sum()),
+            "buy_orders": int(is_buy_order.sum()),
+            "sell_orders": int((~is_buy_order).sum())
+        })
+    return series
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            pass
+    raise ValueError("Unrecognised time: " + value + ". Use seconds since the epoch or YYYY-MM-DD HH:MM:SS")
+
+
+def format_time(value):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value))
+
+
+def print_snapshots(path=HISTORY_DIR):
+    index = load_index(path)
+    print("\n" + str(len(index)) + " order snapshots in " + path)
+    for entry in index:
+        if entry["keyframe"]:
+            print(format_time(entry["time"]) + ": " + str(entry["num_orders"]) + " orders. Full copy, " + str(entry["bytes"]) + " bytes")
+        else:
+            print(format_time(entry["time"]) + ": " + str(entry["num_orders"]) + " orders. " + str(entry["added"]) + " added, " + str(entry["removed"]) + " removed, " + str(entry["changed"]) + " changed, " + str(entry["bytes"]) + " bytes")
+
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--item_name', default=None, help='Writes the price history of this item to --output. Without it, the saved snapshots are listed')
+    parser.add_argument('--region', default=None, help='Limits the price history to one region. Default all regions')
+    parser.add_argument('--start', default=None, help='Only snapshots taken at or after this time, e.g. "2018-06-01 12:00:00"')
+    parser.add_argument('--end', default=None, help='Only snapshots taken at or before this time')
+    parser.add_argument('--output', default="./output/price_history.csv", help='Where to write the price history')
+    args = parser.parse_args()
+
+    if args.item_name is None:
+        print_snapshots()
+    else:
+        import pure_arbitrage as pa
+        lookups = pa.get_name_lookups()
+        type_ids = [int(type_id) for type_id, type_name in lookups["types"].items() if type_name == args.item_name]
+        regions = None
+        if args.region is not None:
+            regions = [int(region) for region, region_name in lookups["regions"].items() if region_name == args.region]
+        if len(type_ids) == 0:
+            print("No item called " + args.item_name)
+        else:
+            series = get_price_series(type_ids[0], regions, parse_time(args.start), parse_time(args.end))
+            u.write_to_csv(SERIES_HEADER, series, args.output)
+            print("\n" + str(len(series)) + " snapshots of " + args.item_name + " written to " + args.output)
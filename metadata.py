@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import utils as u
+import metrics
+
+METADATA_DB = "./data/metadata.db"
+KINDS = ["systems", "types", "stargates", "constellations"]
+
+# SQLite caps the number of variables in one statement
+MAX_VARIABLES = 900
+
+# Number of missing ids downloaded between saves
+DOWNLOAD_BATCH_SIZE = 500
+
+_store = None
+
+
+def get_store(path=METADATA_DB):
+    global _store
+    if _store is None or _store.path != path:
+        _store = MetadataStore(path)
+    return _store
+
+
+class MetadataStore(object):
+
+    def __init__(self, path=METADATA_DB):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        for kind in KINDS:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS " + kind + " (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS routes (origin INTEGER, destination INTEGER, flag TEXT, route TEXT NOT NULL, PRIMARY KEY (origin, destination, flag))"
+        )
+        self.connection.commit()
+        self._cache = {kind: {} for kind in KINDS}
+
+    def get(self, kind, id):
+        # Lazy single key lookup. Rows are only parsed the first time they're asked for
+        if id not in self._cache[kind]:
+            row = self.connection.execute("SELECT data FROM " + kind + " WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                return None
+            self._cache[kind][id] = json.loads(row[0])
+        return self._cache[kind][id]
+
+    def get_many(self, kind, ids):
+        wanted = [id for id in set(ids) if id not in self._cache[kind]]
+        for chunk in _chunks(wanted, MAX_VARIABLES):
+            rows = self.connection.execute(
+                "SELECT id, data FROM " + kind + " WHERE id IN (" + ",".join("?"*len(chunk)) + ")", chunk
+            )
+            for id, data in rows:
+                self._cache[kind][id] = json.loads(data)
+        return {id: self._cache[kind][id] for id in ids if id in self._cache[kind]}
+
+    def missing(self, kind, ids):
+        ids = list(set(ids))
+        found = set(id for id in ids if id in self._cache[kind])
+        for chunk in _chunks([id for id in ids if id not in found], MAX_VARIABLES):
+            rows = self.connection.execute(
+                "SELECT id FROM " + kind + " WHERE id IN (" + ",".join("?"*len(chunk)) + ")", chunk
+            )
+            found.update(row[0] for row in rows)
+        return sorted(id for id in ids if id not in found)
+
+    def put_many(self, kind, data_by_id):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO " + kind + " (id, data) VALUES (?, ?)",
+            [(id, json.dumps(data)) for id, data in data_by_id.items()]
+        )
+        self.connection.commit()
+        self._cache[kind].update(data_by_id)
+
+    def get_routes(self, od_pairs, flag="secure"):
+        route_by_od_pair = {}
+        for origin, destination in set(od_pairs):
+            row = self.connection.execute(
+                "SELECT route FROM routes WHERE origin = ? AND destination = ? AND flag = ?", (origin, destination, flag)
+            ).fetchone()
+            if row is not None:
+                route_by_od_pair[(origin, destination)] = json.loads(row[0])
+        return route_by_od_pair
+
+    def put_routes(self, route_by_od_pair, flag="secure"):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO routes (origin, destination, flag, route) VALUES (?, ?, ?, ?)",
+            [(od_pair[0], od_pair[1], flag, json.dumps(route)) for od_pair, route in route_by_od_pair.items()]
+        )
+        self.connection.commit()
+
+
+def get_details(store, kind, ids, url_for, legacy_fileloc_for=None, concurrency=u.DEFAULT_CONCURRENCY):
+    missing = store.missing(kind, ids)
+    metrics.increment("metadata." + kind + ".hits", len(set(ids)) - len(missing))
+    metrics.increment("metadata." + kind + ".misses", len(missing))
+    if len(missing) > 0:
+        print("\nGetting " + str(len(missing)) + " " + kind + " that aren't saved yet")
+        fetched = {}
+        to_download = []
+        for id in missing:
+            data = load_legacy_file(legacy_fileloc_for(id)) if legacy_fileloc_for is not None else None
+            if data is None:
+                to_download.append(id)
+            elif is_valid(data):
+                fetched[id] = data
+        store.put_many(kind, fetched)
+
+        # Saved after every batch so an interrupted run doesn't have to start again
+        for n, batch in enumerate(_chunks(to_download, DOWNLOAD_BATCH_SIZE)):
+            u.overwrite_print("--> Getting " + kind + " batch " + str(n + 1) + "/" + str((len(to_download) + DOWNLOAD_BATCH_SIZE - 1)//DOWNLOAD_BATCH_SIZE))
+            data_by_id = dict(zip(batch, u.download_many([url_for(id) for id in batch], concurrency)))
+            store.put_many(kind, {id: data for id, data in data_by_id.items() if is_valid(data)})
+        print("")
+    return store.get_many(kind, ids)
+
+
+def load_legacy_file(fileloc):
+    # Details saved one JSON file per entity by older versions. Imported once so they don't need re-downloading
+    if fileloc is None or not os.path.isfile(fileloc):
+        return None
+    with open(fileloc) as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            return None
+    return data if is_valid(data) else None
+
+
+def is_valid(data):
+    return isinstance(data, (dict, list)) and len(data) > 0 and not (isinstance(data, dict) and "error" in data)
+
+
+def _chunks(values, size):
+    return [values[k:k + size] for k in range(0, len(values), size)]
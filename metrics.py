@@ -0,0 +1,93 @@
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+REPORT_FILE = "./output/run_report.json"
+PROFILE_FILE = "./output/scan.prof"
+
+# Counters and timings for the current run. Downloads record from many threads at once, so everything goes through the lock
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_started = [time.time()]
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _started[0] = time.time()
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def add_time(name, seconds, calls=1):
+    with _lock:
+        timing = _timings.setdefault(name, {"seconds": 0.0, "calls": 0})
+        timing["seconds"] += seconds
+        timing["calls"] += calls
+
+
+@contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def stage(name):
+    # Stages are the top level steps of a run. Everything else timed is a call made somewhere inside them
+    return timer("stage." + name)
+
+
+def snapshot():
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "timings": {name: dict(timing) for name, timing in _timings.items()}
+        }
+
+
+def merge(other):
+    # Adds in a snapshot taken in another process, e.g. a scan worker
+    for name, value in other["counters"].items():
+        increment(name, value)
+    for name, timing in other["timings"].items():
+        add_time(name, timing["seconds"], timing["calls"])
+
+
+def get_report(params=None):
+    current = snapshot()
+    finished = time.time()
+    return {
+        "started": _started[0],
+        "finished": finished,
+        "seconds": finished - _started[0],
+        "params": params or {},
+        "stages": {name[len("stage."):]: timing for name, timing in current["timings"].items() if name.startswith("stage.")},
+        "timings": {name: timing for name, timing in current["timings"].items() if not name.startswith("stage.")},
+        "counters": current["counters"]
+    }
+
+
+def write_report(fileloc=REPORT_FILE, params=None):
+    with open(fileloc, "w") as f:
+        json.dump(get_report(params), f, indent=2, sort_keys=True)
+    print("\nRun report written to " + fileloc)
+
+
+def profile(fileloc, function, *args):
+    # Runs function under cProfile and saves the stats for pstats/snakeviz. Only sees the calling process
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(fileloc)
+        print("\nProfile written to " + fileloc)
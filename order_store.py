@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+STORE_DIR = "./data/orders/store"
+
+# Names aren't stored. They're resolved from the lookups by id when needed
+COLUMNS = [
+    ("order_id", np.int64),
+    ("type_id", np.int32),
+    ("region", np.int32),
+    ("system_id", np.int32),
+    ("location_id", np.int64),
+    ("is_buy_order", np.bool_),
+    ("price", np.float64),
+    ("volume_remain", np.int64),
+    ("volume_total", np.int64),
+    ("min_volume", np.int64),
+    ("duration", np.int32),
+    ("issued", "S20"),
+    ("range", "S11")
+]
+COLUMN_DTYPES = dict(COLUMNS)
+
+# One order as a fixed size record, about 100 bytes against the best part of a kilobyte as a dict
+ORDER_DTYPE = np.dtype(COLUMNS)
+
+
+def to_python(value):
+    # NumPy scalars to plain Python values. Fixed width strings come back as bytes on Python 3
+    value = value.item() if hasattr(value, "item") else value
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode("ascii")
+    return value
+
+
+def get_records(orders, region=None):
+    # Orders as they come from ESI. region is used for any that don't say which region they're in
+    records = []
+    for order in orders:
+        if isinstance(order, dict):
+            records.append(tuple([order.get(name, region) if name == "region" and region is not None else order[name] for name, dtype in COLUMNS]))
+    return np.array(records, dtype=ORDER_DTYPE)
+
+
+def store_exists(path=STORE_DIR):
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+
+# Rows copied at a time when carrying regions over from the current store
+CHUNK_SIZE = 1 << 18
+
+
+class StoreWriter(object):
+    # Builds a new store from chunks of orders without holding them all at once. Each chunk is appended to one raw file
+    # per column, and the columns are only sorted into a store, one at a time, on close
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self.chunk_path = path + ".chunks"
+        if os.path.isdir(self.chunk_path):
+            shutil.rmtree(self.chunk_path)
+        os.makedirs(self.chunk_path)
+        self.files = {name: open(os.path.join(self.chunk_path, name + ".bin"), "wb") for name, dtype in COLUMNS}
+        self.num_orders = 0
+        self.type_ids = set()
+
+    def append(self, columns):
+        for name, dtype in COLUMNS:
+            np.asarray(columns[name], dtype=dtype).tofile(self.files[name])
+        self.num_orders += len(columns["type_id"])
+
+    def append_orders(self, orders, region=None):
+        records = get_records(orders, region)
+        self.type_ids.update(np.unique(records["type_id"]).tolist())
+        self.append(records)
+
+    def carry_over(self, store, regions):
+        region = store.column("region")
+        for start in range(0, len(store), CHUNK_SIZE):
+            keep = np.isin(region[start:start + CHUNK_SIZE], regions)
+            if keep.any():
+                self.append({name: store.column(name)[start:start + CHUNK_SIZE][keep] for name, dtype in COLUMNS})
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        columns = {}
+        for name, dtype in COLUMNS:
+            fileloc = os.path.join(self.chunk_path, name + ".bin")
+            if self.num_orders > 0:
+                columns[name] = np.memmap(fileloc, dtype=dtype, mode="r", shape=(self.num_orders,))
+            else:
+                columns[name] = np.empty(0, dtype=dtype)
+        write_columns(columns, self.path)
+        del columns
+        shutil.rmtree(self.chunk_path)
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.chunk_path)
+
+
+def write_columns(columns, path=STORE_DIR):
+    # Sort by (type_id, is_buy_order, price) so each item's sell orders and then buy orders are contiguous slices,
+    # cheapest first. Orders at the same price keep the order they came in
+    type_id = np.asarray(columns["type_id"])
+    is_buy_order = np.asarray(columns["is_buy_order"])
+    order = np.lexsort((np.asarray(columns["price"]), is_buy_order, type_id))
+    type_id = type_id[order]
+    is_buy_order = is_buy_order[order]
+    type_ids, starts = np.unique(type_id, return_index=True)
+    offsets = np.append(starts, len(order)).astype(np.int64)
+    # Where each item's buy orders start. Sells come first, so it's the item's end if there are no buys
+    buy_offsets = np.searchsorted(type_id.astype(np.int64)*2 + is_buy_order, type_ids.astype(np.int64)*2 + 1).astype(np.int64)
+    del type_id, is_buy_order
+
+    tmp_path = path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    # One column at a time, so only one is ever fully in memory
+    for name, dtype in COLUMNS:
+        np.save(os.path.join(tmp_path, name + ".npy"), np.asarray(columns[name], dtype=dtype)[order])
+    np.save(os.path.join(tmp_path, "index_type_id.npy"), type_ids.astype(np.int32))
+    np.save(os.path.join(tmp_path, "index_offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "index_buy_offsets.npy"), buy_offsets)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "num_orders": len(order),
+            "num_types": len(type_ids),
+            "sorted_by": ["type_id", "is_buy_order", "price"],
+            "regions": np.unique(columns["region"]).tolist(),
+            "created": time.time()
+        }, f)
+
+    # Swap the new snapshot in whole so readers never see a half written store
+    old_path = path + ".old"
+    if os.path.isdir(old_path):
+        shutil.rmtree(old_path)
+    if os.path.isdir(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.isdir(old_path):
+        shutil.rmtree(old_path)
+
+
+class OrderStore(object):
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.type_ids = np.load(os.path.join(path, "index_type_id.npy"))
+        self.offsets = np.load(os.path.join(path, "index_offsets.npy"))
+        # Stores written before orders were sorted by side and price only have the per item index
+        buy_offsets_fileloc = os.path.join(path, "index_buy_offsets.npy")
+        self.buy_offsets = np.load(buy_offsets_fileloc) if os.path.isfile(buy_offsets_fileloc) else None
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta["num_orders"]
+
+    def regions(self):
+        if "regions" not in self.meta:
+            self.meta["regions"] = np.unique(self.column("region")).tolist()
+        return self.meta["regions"]
+
+    def column(self, name):
+        if name not in self._columns:
+            # Memory map so only the pages that are actually touched get read
+            mmap_mode = "r" if len(self) > 0 else None
+            self._columns[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode=mmap_mode)
+        return self._columns[name]
+
+    def values(self, name, start, end):
+        # A plain ndarray over the mapped pages. Indexing a memmap slice makes a memmap scalar every time, which is far
+        # slower when rows are built one order at a time
+        return self.column(name)[start:end].view(np.ndarray)
+
+    def item_range(self, type_id):
+        k = np.searchsorted(self.type_ids, type_id)
+        if k == len(self.type_ids) or self.type_ids[k] != type_id:
+            return 0, 0
+        return int(self.offsets[k]), int(self.offsets[k + 1])
+
+    def side_range(self, type_id, is_buy_order):
+        k = np.searchsorted(self.type_ids, type_id)
+        if k == len(self.type_ids) or self.type_ids[k] != type_id:
+            return 0, 0
+        if is_buy_order:
+            return int(self.buy_offsets[k]), int(self.offsets[k + 1])
+        return int(self.offsets[k]), int(self.buy_offsets[k])
+
+    def side(self, type_id, is_buy_order, columns):
+        # One side of an item's book, cheapest first
+        start, end = self.side_range(type_id, is_buy_order)
+        return {name: self.values(name, start, end) for name in columns}
+
+    def order(self, row):
+        return {name: to_python(self.column(name)[row]) for name, dtype in COLUMNS}
+
+    def item(self, type_id, columns):
+        start, end = self.item_range(type_id)
+        return {name: self.values(name, start, end) for name in columns}
+
+    def book(self, type_id, columns):
+        if self.buy_offsets is not None:
+            return {"buy": self.side(type_id, True, columns), "sell": self.side(type_id, False, columns)}
+        start, end = self.item_range(type_id)
+        is_buy_order = self.values("is_buy_order", start, end)
+        book = {"buy": {}, "sell": {}}
+        for name in columns:
+            values = self.values(name, start, end)
+            book["buy"][name] = values[is_buy_order]
+            book["sell"][name] = values[~is_buy_order]
+        return book
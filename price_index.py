@@ -0,0 +1,200 @@
+import json
+import threading
+import numpy as np
+
+DEFAULT_PORT = 8470
+
+
+def get_is_buy_order(side):
+    side = side.lower()
+    if side not in ["buy", "sell"]:
+        raise ValueError("Unrecognised side: " + side + ". Please select 'Buy' or 'Sell'")
+    return side == "buy"
+
+
+class PriceIndex(object):
+
+    def __init__(self, store, regions=None):
+        self.store = store
+        rows = np.arange(len(store)) if regions is None else np.flatnonzero(np.isin(store.column("region"), regions))
+        is_buy_order = np.asarray(store.column("is_buy_order"))[rows]
+        price = np.asarray(store.column("price"))[rows]
+
+        # One segment per (type_id, is_buy_order), best price first. Ties keep the store's order
+        key = np.asarray(store.column("type_id"))[rows].astype(np.int64)*2 + is_buy_order
+        order = np.lexsort((np.where(is_buy_order, -price, price), key))
+        self.rows = rows[order]
+        self.price = price[order]
+        self.volume = np.asarray(store.column("volume_remain"))[self.rows].astype(np.int64)
+        self.keys, starts = np.unique(key[order], return_index=True)
+        self.offsets = np.append(starts, len(self.rows)).astype(np.int64)
+        segment = np.repeat(np.arange(len(self.keys), dtype=np.int64), np.diff(self.offsets))
+
+        # Volume available before each order. Cumulative across every segment, so it only ever goes up
+        self.cum_volume = np.concatenate(([0], np.cumsum(self.volume))).astype(np.int64)
+
+        # Largest single order seen so far in each segment, shifted by segment so the whole array is sorted too
+        self.span = int(self.volume.max()) + 1 if len(self.volume) > 0 else 1
+        self.max_volume = np.maximum.accumulate(segment*self.span + self.volume) if len(self.volume) > 0 else self.volume
+
+        # Cost of filling every order before this one in its segment. Kept per segment so big items don't swamp small ones
+        notional = self.price*self.volume
+        self.notional_before = np.empty(len(self.rows), dtype=np.float64)
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            self.notional_before[start:end] = np.cumsum(notional[start:end]) - notional[start:end]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def segments(self, type_ids, is_buy_orders):
+        keys = np.asarray(type_ids, dtype=np.int64)*2 + np.asarray(is_buy_orders, dtype=np.int64)
+        k = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = (self.keys[k] == keys) if len(self.keys) > 0 else np.zeros(len(keys), dtype=bool)
+        starts = np.where(found, self.offsets[k], 0)
+        ends = np.where(found, self.offsets[np.minimum(k + 1, len(self.offsets) - 1)], 0)
+        return k, starts, ends
+
+    def best_positions(self, type_ids, is_buy_orders, quantities=1):
+        # Position of the best priced order with at least quantity remaining, or -1
+        type_ids = np.atleast_1d(type_ids)
+        segment, starts, ends = self.segments(type_ids, np.broadcast_to(is_buy_orders, type_ids.shape))
+        quantities = np.clip(np.broadcast_to(np.asarray(quantities, dtype=np.int64), type_ids.shape), 0, self.span)
+        positions = np.searchsorted(self.max_volume, segment*self.span + quantities, side="left")
+        return np.where((positions >= starts) & (positions < ends), positions, -1)
+
+    def fills(self, type_ids, is_buy_orders, quantities):
+        # Filling quantity by walking down the book from the best price. Returns the amount filled and what it costs
+        type_ids = np.atleast_1d(type_ids)
+        segment, starts, ends = self.segments(type_ids, np.broadcast_to(is_buy_orders, type_ids.shape))
+        quantities = np.broadcast_to(np.asarray(quantities, dtype=np.int64), type_ids.shape)
+        available = self.cum_volume[ends] - self.cum_volume[starts]
+        filled = np.minimum(quantities, available)
+
+        # The order the fill finishes in, then everything before it plus part of it
+        last = np.searchsorted(self.cum_volume, self.cum_volume[starts] + filled, side="left") - 1
+        last = np.clip(last, starts, np.maximum(ends - 1, starts))
+        has_orders = (ends > starts) & (filled > 0)
+        last = np.where(has_orders, last, 0)
+        remaining = filled - (self.cum_volume[last] - self.cum_volume[starts])
+        totals = np.where(has_orders, self.notional_before[last] + remaining*self.price[last], 0.0) if len(self.rows) > 0 else np.zeros(len(type_ids))
+        return filled, totals
+
+    def best(self, type_id, is_buy_order, quantity=1):
+        position = int(self.best_positions([type_id], is_buy_order, quantity)[0])
+        if position < 0:
+            return None
+        return self.order_at(position)
+
+    def fill(self, type_id, is_buy_order, quantity):
+        filled, totals = self.fills([type_id], is_buy_order, quantity)
+        return get_fill_result(quantity, int(filled[0]), float(totals[0]))
+
+    def order_at(self, position):
+        return self.store.order(int(self.rows[position]))
+
+
+def get_fill_result(quantity, filled, total):
+    return {
+        "quantity": quantity,
+        "filled": filled,
+        "total": total,
+        "average_price": total/filled if filled > 0 else None
+    }
+
+
+def parse_queries(queries, type_id_by_name=None):
+    # queries: [{"type_id" or "item_name", "side", "quantity"}]. Answered together so thousands cost about the same as one
+    results = [None]*len(queries)
+    valid = []
+    for k, query in enumerate(queries):
+        try:
+            type_id = query["type_id"] if "type_id" in query else (type_id_by_name or {})[query["item_name"]]
+            valid.append((k, int(type_id), get_is_buy_order(query.get("side", "Buy")), int(query.get("quantity", 1))))
+        except (KeyError, ValueError, TypeError) as e:
+            results[k] = {"error": "Bad query: " + str(e)}
+    return valid, results
+
+
+def best_many(index, queries, type_id_by_name=None):
+    valid, results = parse_queries(queries, type_id_by_name)
+    if len(valid) > 0:
+        ks, type_ids, is_buy_orders, quantities = zip(*valid)
+        positions = index.best_positions(np.array(type_ids), np.array(is_buy_orders), np.array(quantities))
+        for k, position in zip(ks, positions.tolist()):
+            results[k] = index.order_at(position) if position >= 0 else None
+    return results
+
+
+def fill_many(index, queries, type_id_by_name=None):
+    valid, results = parse_queries(queries, type_id_by_name)
+    if len(valid) > 0:
+        ks, type_ids, is_buy_orders, quantities = zip(*valid)
+        filled, totals = index.fills(np.array(type_ids), np.array(is_buy_orders), np.array(quantities))
+        for k, quantity, item_filled, total in zip(ks, quantities, filled.tolist(), totals.tolist()):
+            results[k] = get_fill_result(quantity, item_filled, total)
+    return results
+
+
+def serve(index, type_id_by_name=None, host="127.0.0.1", port=DEFAULT_PORT):
+    # GET /best and /fill take type_id or item_name, side and quantity as query parameters.
+    # POST /best and /fill take a JSON list of the same and answer them all at once.
+    # The server modules are only imported here so one off lookups don't pay for them
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import urlparse, parse_qs
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlparse, parse_qs
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    lock = threading.Lock()
+    handlers = {"/best": best_many, "/fill": fill_many}
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def respond(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in handlers:
+                return self.respond({"error": "Unknown path. Use /best or /fill"}, 404)
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            with lock:
+                result = handlers[url.path](index, [query], type_id_by_name)[0]
+            self.respond(result, 400 if isinstance(result, dict) and "error" in result else 200)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path not in handlers:
+                return self.respond({"error": "Unknown path. Use /best or /fill"}, 404)
+            try:
+                queries = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            except ValueError:
+                return self.respond({"error": "Body must be a JSON list of queries"}, 400)
+            if not isinstance(queries, list):
+                return self.respond({"error": "Body must be a JSON list of queries"}, 400)
+            with lock:
+                results = handlers[url.path](index, queries, type_id_by_name)
+            self.respond(results)
+
+        def log_message(self, format, *args):
+            return
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("Serving prices for " + str(len(index)) + " orders at http://" + host + ":" + str(port) + " (/best, /fill). Stop it with Ctrl-C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving")
+    finally:
+        server.server_close()
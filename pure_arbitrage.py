@@ -1,9 +1,16 @@
-import json
-import requests
-import csv
-import pandas as pd
-import sys
+import os
+import time
+import heapq
+import multiprocessing
+import numpy as np
 import utils as u
+import scan as sc
+import order_store as ost
+import routing as rt
+import metadata as md
+import metrics
+import history as hist
+import hauls as hl
 import argparse
 
 SAFE_REGIONS = [
@@ -30,42 +37,76 @@ SAFE_REGIONS = [
     "Metropolis"
 ]
 
+SYSTEM_NAMES_FILE = "./data/systems/systems_names.json"
 
-def get_name_lookup(type, paged=False, force=False):
+# Order store columns the arbitrage scan and its output rows need
+ORDER_COLUMNS = ["region", "system_id", "location_id", "price", "min_volume", "volume_remain"]
+
+OPPORTUNITY_HEADER = [
+    "item_id", "item", "buy_in_region", "buy_in_system_name", "buy_in_location_id",
+    "sell_in_region", "sell_in_system_name", "sell_in_location_id",
+    "buy_price", "sell_price", "buy_min_volume", "sell_min_volume", "amount_available_to_buy",
+    "amount_able_to_be_sold", "margin", "potential_revenue", "_buy_system", "_sell_system",
+    "buy_system_sec", "sell_system_sec", "item_volume"
+]
+
+# Extra columns in depth mode. Prices are then the average over every order matched, and amounts are what can actually be traded
+DEPTH_HEADER = ["orders_to_buy_from", "orders_to_sell_to"]
+
+# More shards than workers so one worker landing on a few huge items doesn't hold up the rest
+SHARDS_PER_WORKER = 8
+
+# Don't poll ESI more often than this in watch mode, even if a region's cache has already expired
+MIN_WATCH_SLEEP = 30
+
+
+def get_names_by_ids(names):
+    names_by_ids = {}
+    for n in names:
+        names_by_ids[str(n["id"])] = n["name"].replace(",", "-").replace("/", "-")
+    return names_by_ids
+
+
+def get_name_lookup(type, paged=False, force=False, concurrency=u.DEFAULT_CONCURRENCY):
+
+    # Saved names are loaded from their compiled copy, skipping the ids altogether
+    names_fileloc = "./data/" + type + "/" + type + "_names.json"
+    if force == False and os.path.isfile(names_fileloc):
+        names_by_ids = u.load_compiled(names_fileloc, lambda: get_names_by_ids(u.load_data(names_fileloc)))
+        if len(names_by_ids) > 0:
+            return names_by_ids
 
     print("\nGetting " + type + " ids")
-    url = "https://esi.evetech.net/latest/universe/" + type + "/?datasource=tranquility"
+    url = u.ESI_URL + "/universe/" + type + "/?datasource=tranquility"
     ids = u.get_data(
         url=url,
         fileloc="./data/" + type + "/" + type + ".json",
         paged=paged,
-        force=force
+        force=force,
+        concurrency=concurrency
     )
 
     print("\nGetting " + type + " names")
-    url = "https://esi.evetech.net/latest/universe/names/?datasource=tranquility"
+    url = u.ESI_URL + "/universe/names/?datasource=tranquility"
     names = u.get_data(
         url=url,
-        fileloc="./data/" + type + "/" + type + "_names.json",
+        fileloc=names_fileloc,
         request_type="post",
         post_data=ids,
         post_in_batches=True,
         batch_size=1000,
-        force=force
+        force=force,
+        concurrency=concurrency
     )
 
-    names_by_ids = {}
-    for n in names:
-        names_by_ids[str(n["id"])] = n["name"].replace(",", "-").replace("/", "-")
+    return get_names_by_ids(names)
 
-    return names_by_ids
 
-
-def get_name_lookups(force=False):
+def get_name_lookups(force=False, concurrency=u.DEFAULT_CONCURRENCY):
     print("\n------------- Getting lookups -------------")
-    region_name_by_region = get_name_lookup("regions", force=force)
-    system_name_by_system = get_name_lookup("systems", force=force)
-    type_name_by_type = get_name_lookup("types", force=force, paged=True)
+    region_name_by_region = get_name_lookup("regions", force=force, concurrency=concurrency)
+    system_name_by_system = get_name_lookup("systems", force=force, concurrency=concurrency)
+    type_name_by_type = get_name_lookup("types", force=force, paged=True, concurrency=concurrency)
     print("")
     return {
         "regions": region_name_by_region,
@@ -74,204 +115,257 @@ def get_name_lookups(force=False):
     }
 
 
-def get_and_save_orders(force=False, force_lookups=False, safe_regions=True):
+def get_and_save_orders(force=False, force_lookups=False, safe_regions=True, concurrency=u.DEFAULT_CONCURRENCY, history_days=0):
 
-    lookups = get_name_lookups(force_lookups)
+    lookups = get_name_lookups(force_lookups, concurrency)
     region_name_by_region = lookups["regions"]
-    system_name_by_system = lookups["systems"]
-    type_name_by_type = lookups["types"]
 
     print("\n------------- Getting Orders -------------\n")
-    orders = []
-    num_regions = len(region_name_by_region.keys())
-    for i, region in enumerate(region_name_by_region.keys()):
-        if safe_regions and region_name_by_region[region] not in SAFE_REGIONS:
-            continue
-        u.overwrite_print("---> Working on region: " + region_name_by_region[region] + ". " + str(i + 1) + "/" + str(num_regions))
-        url = "https://esi.evetech.net/latest/markets/" + region + "/orders/?datasource=tranquility&order_type=all"
-        orders_for_region = u.get_data(
-            url=url,
-            fileloc="./data/orders/" + region_name_by_region[region] + ".json",
+    regions, urls, filelocs = get_order_sources(region_name_by_region, safe_regions)
+    print("---> Working on " + str(len(regions)) + " regions")
+    store = ost.OrderStore() if ost.store_exists() else None
+    stored_regions = set(store.regions()) if store is not None else set()
+
+    # Each page goes straight into the new store as it arrives, so only a few pages are ever in memory at once
+    writer = ost.StoreWriter()
+    try:
+        changed_by_region, streamed_by_region = u.stream_paged_data_many(
+            urls=urls,
+            filelocs=filelocs,
+            on_page=lambda k, page: writer.append_orders(page, int(regions[k])),
             force=force,
-            paged=True
+            concurrency=concurrency
         )
-        orders_for_region[:] = [o for o in orders_for_region if o != u'error']
-        for j, order in enumerate(orders_for_region):
-            orders_for_region[j]["region"] = region
-            orders_for_region[j]["region_name"] = region_name_by_region[region]
-            orders_for_region[j]["system_name"] = system_name_by_system[str(orders_for_region[j]["system_id"])]
-            orders_for_region[j]["type_name"] = type_name_by_type[str(orders_for_region[j]["type_id"])]
-
-        orders += orders_for_region
-
-    # Encode everything to ensure we can write to csv
-    print("\nEncoding to utf-8")
-    for i, order in enumerate(orders):
-        orders[i] = {k: unicode(v).encode("utf-8") for k,v in orders[i].iteritems()}
-
-    u.write_to_csv(
-        [
-            "region","region_name","duration","is_buy_order","issued","location_id",
-            "min_volume","order_id","price","range","system_id","system_name",
-            "type_id","type_name","volume_remain","volume_total"
-        ],
-        orders,
-        "./data/orders/orders.csv",
-        d=True
-    )
 
-    return
+        # Regions still in their cache window are carried over from the store, or read from their saved pages if they aren't in it yet
+        keep_regions = []
+        unchanged_regions = []
+        for k, region in enumerate(regions):
+            if int(region) in stored_regions and not changed_by_region[k]:
+                unchanged_regions.append(int(region))
+                if not streamed_by_region[k]:
+                    keep_regions.append(int(region))
+            elif not streamed_by_region[k]:
+                for page in u.read_pages(filelocs[k]):
+                    writer.append_orders(page, int(region))
+
+        # Regions that changed or weren't in the store yet, plus any that dropped out of it
+        changed_regions = sorted((stored_regions | set(int(region) for region in regions)) - set(unchanged_regions))
+        if len(changed_regions) == 0:
+            print("\nNo regions have changed. Order store is up to date")
+            writer.abort()
+            return changed_regions
+
+        u.overwrite_print("<< Writing " + str(writer.num_orders) + " orders to store at " + ost.STORE_DIR + ". Keeping " + str(len(keep_regions)) + " regions as they are")
+        if len(keep_regions) > 0:
+            writer.carry_over(store, keep_regions)
+        writer.close()
+    except BaseException:
+        if os.path.isdir(writer.chunk_path):
+            writer.abort()
+        raise
+    print("")
+
+    # With history on, every refresh is kept as a delta on the one before, so past order books can be rebuilt later
+    if history_days > 0:
+        print("\nSaving order snapshot to " + hist.HISTORY_DIR)
+        with metrics.timer("history.record"):
+            entry = hist.record(ost.OrderStore(), keep_days=history_days)
+        if not entry["keyframe"]:
+            print(str(entry["added"]) + " orders added, " + str(entry["removed"]) + " removed and " + str(entry["changed"]) + " changed since the last snapshot")
 
+    # Details for any items that are new to the market are saved now, so adding item volumes after the scan is just a lookup
+    print("\nPrefetching details for items with orders")
+    get_type_details(lookups["types"], sorted(writer.type_ids), concurrency)
 
-def get_type_details(type_name_by_type, type_ids):
+    return changed_regions
+
+
+def get_order_sources(region_name_by_region, safe_regions=True):
+    regions = [region for region in region_name_by_region.keys() if not (safe_regions and region_name_by_region[region] not in SAFE_REGIONS)]
+    urls = [u.ESI_URL + "/markets/" + region + "/orders/?datasource=tranquility&order_type=all" for region in regions]
+    filelocs = ["./data/orders/" + region_name_by_region[region] + ".json" for region in regions]
+    return regions, urls, filelocs
+
+
+def get_type_details(type_name_by_type, type_ids, concurrency=u.DEFAULT_CONCURRENCY):
 
     num_types = len(type_ids)
-    print("\n\nWarning! Getting details for " + str(num_types) + " items.")
-    print("This could take roughly: " + str(num_types*2/60) + " minutes if they're not already saved")
-    type_details = {}
-    for i, type_id in enumerate(type_name_by_type):
-        if type_id not in type_ids:
-            continue
-        u.overwrite_print("--> Getting type: " + type_name_by_type[type_id] + "." + str(i) + "/" + str(num_types))
-        url = "https://esi.evetech.net/latest/universe/types/" + type_id + "/?datasource=tranquility&language=en-us"
-
-        type_details[type_name_by_type[type_id]] = u.get_data(
-            url=url,
-            fileloc="./data/types/" + type_name_by_type[type_id] + ".json"
-        )
-    print("")
-    return type_details
+    print("\n\nGetting details for " + str(num_types) + " items")
+    return md.get_details(
+        md.get_store(),
+        "types",
+        type_ids,
+        url_for=lambda type_id: u.ESI_URL + "/universe/types/" + str(type_id) + "/?datasource=tranquility&language=en-us",
+        legacy_fileloc_for=lambda type_id: "./data/types/" + type_name_by_type.get(str(type_id), "") + ".json",
+        concurrency=concurrency
+    )
 
 
 def get_routes_by_od_pairs(od_pairs_and_names):
     num_od_pairs = len(od_pairs_and_names)
-    print("\n\nWarning! Getting details for " + str(num_od_pairs) + " origin-destination pairs.")
-    print("This could take roughly: " + str(num_od_pairs*2/60) + " minutes if they're not already saved")
-    route_by_od_pair = {}
-    for i, od_pair in enumerate(od_pairs_and_names):
-        u.overwrite_print("--> Getting route: " + od_pair[2] + "-->" + od_pair[3] + "." + str(i) + "/" + str(num_od_pairs))
-        route_by_od_pair[od_pair] = u.get_data(
-            url="https://esi.evetech.net/latest/route/" + str(od_pair[0]) + "/" + str(od_pair[1]) + "/?datasource=tranquility&flag=secure",
-            fileloc="./data/routes/" + str(od_pair[2]) + "_to_" + str(od_pair[3]) + ".json",
-        )
+    store = md.get_store()
+    route_by_system_pair = store.get_routes([(od_pair[0], od_pair[1]) for od_pair in od_pairs_and_names])
+    missing = [od_pair for od_pair in od_pairs_and_names if (od_pair[0], od_pair[1]) not in route_by_system_pair]
+    metrics.increment("metadata.routes.hits", num_od_pairs - len(missing))
+    metrics.increment("metadata.routes.misses", len(missing))
+    print("\n\nWarning! Getting details for " + str(len(missing)) + " origin-destination pairs.")
+    print("This could take roughly: " + str(len(missing)*2/60) + " minutes")
+    fetched = {}
+    for i, od_pair in enumerate(missing):
+        u.overwrite_print("--> Getting route: " + od_pair[2] + "-->" + od_pair[3] + "." + str(i) + "/" + str(len(missing)))
+        route = md.load_legacy_file("./data/routes/" + str(od_pair[2]) + "_to_" + str(od_pair[3]) + ".json")
+        if route is None:
+            route = u.download_data(u.ESI_URL + "/route/" + str(od_pair[0]) + "/" + str(od_pair[1]) + "/?datasource=tranquility&flag=secure")
+        if md.is_valid(route):
+            fetched[(od_pair[0], od_pair[1])] = route
+    store.put_routes(fetched)
+    route_by_system_pair.update(fetched)
     print("")
 
-    return route_by_od_pair
+    return {od_pair: route_by_system_pair.get((od_pair[0], od_pair[1]), []) for od_pair in od_pairs_and_names}
+
 
+def get_local_routes_by_od_pairs(od_pairs_and_names, systems):
+    print("\n\nFinding routes for " + str(len(od_pairs_and_names)) + " origin-destination pairs on the local jump graph")
+    graph = systems.jump_graph()
+    with metrics.timer("routes.local"):
+        route_by_system_pair = graph.routes([(od_pair[0], od_pair[1]) for od_pair in od_pairs_and_names], secure=True)
+    return {od_pair: route_by_system_pair[(od_pair[0], od_pair[1])] for od_pair in od_pairs_and_names}
 
-def get_system_details(system_name_by_system):
+
+def get_system_details(system_name_by_system, concurrency=u.DEFAULT_CONCURRENCY):
 
     num_systems = len(system_name_by_system.keys())
-    system_details = {}
-    print ("\nGetting system details for " + str(num_systems) + " systems")
-    for i, system_id in enumerate(system_name_by_system):
-        u.overwrite_print("--> Getting system: " + system_name_by_system[system_id] + "." + str(i+1) + "/" + str(num_systems))
-        url = "https://esi.evetech.net/latest/universe/systems/" + system_id + "/?datasource=tranquility&language=en-us"
-        system_details[system_name_by_system[system_id]] = u.get_data(
-            url=url,
-            fileloc="./data/systems/" + system_name_by_system[system_id] + ".json"
-        )
-    print("")
-    return system_details
+    print("\nGetting system details for " + str(num_systems) + " systems")
+    return md.get_details(
+        md.get_store(),
+        "systems",
+        [int(system_id) for system_id in system_name_by_system],
+        url_for=lambda system_id: u.ESI_URL + "/universe/systems/" + str(system_id) + "/?datasource=tranquility&language=en-us",
+        legacy_fileloc_for=lambda system_id: "./data/systems/" + system_name_by_system[str(system_id)] + ".json",
+        concurrency=concurrency
+    )
 
 
-def get_pure_arbitrage(min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, single_cargo=True, cargo_capacity=0, get_routes=True, get_new_orders=False, get_new_lookups=False, safe_regions=True):
+def get_constellation_details(constellation_ids, concurrency=u.DEFAULT_CONCURRENCY):
+    print("\nGetting constellation details for " + str(len(constellation_ids)) + " constellations")
+    return md.get_details(
+        md.get_store(),
+        "constellations",
+        constellation_ids,
+        url_for=lambda constellation_id: u.ESI_URL + "/universe/constellations/" + str(constellation_id) + "/?datasource=tranquility&language=en-us",
+        concurrency=concurrency
+    )
 
-    if single_cargo and cargo_capacity == 0:
-        print("Please provide a cargo capacity")
-        return
 
-    # can't force another download of the lookups. Assumes they've been saved in get_and_save_orders()
-    lookups = get_name_lookups(force=get_new_lookups)
+def get_system_index(system_name_by_system, concurrency=u.DEFAULT_CONCURRENCY):
+    # Security, region, constellation and stargate neighbours of every system. Compiled next to the system names, so the
+    # details and stargates are only loaded again when the names change, e.g. after --get_new_lookups=True. An index missing
+    # anything isn't saved, so whatever failed to download is tried again next run
+    def build():
+        system_details = get_system_details(system_name_by_system, concurrency)
+        constellation_ids = sorted(set(details["constellation_id"] for details in system_details.values() if "constellation_id" in details))
+        constellation_details = get_constellation_details(constellation_ids, concurrency)
+        index = rt.build_system_index(system_details, constellation_details, concurrency)
+        index["complete"] = index["complete"] and len(system_details) == len(system_name_by_system)
+        return index
+    return rt.SystemIndex(u.load_compiled(SYSTEM_NAMES_FILE, build, "system_index", complete=lambda index: index["complete"]))
+
+
+def _to_list(values):
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return values
+
+
+def get_opportunity_row(item, type_id, buy, sell, i, j, margin, potential_revenue, buy_sec, sell_sec, lookups):
     region_name_by_region = lookups["regions"]
     system_name_by_system = lookups["systems"]
-    type_name_by_type = lookups["types"]
+    return {
+        "item_id": type_id,
+        "item": item.replace(",", "-"),
+        "buy_in_region": region_name_by_region[str(sell["region"][j])],
+        "buy_in_system_name": system_name_by_system[str(sell["system_id"][j])],
+        "buy_in_location_id": int(sell["location_id"][j]),
+        "sell_in_region": region_name_by_region[str(buy["region"][i])],
+        "sell_in_system_name": system_name_by_system[str(buy["system_id"][i])],
+        "sell_in_location_id": int(buy["location_id"][i]),
+        "buy_price": float(sell["price"][j]),
+        "sell_price": float(buy["price"][i]),
+        "buy_min_volume": int(sell["min_volume"][j]),
+        "sell_min_volume": int(buy["min_volume"][i]),
+        "amount_available_to_buy": int(sell["volume_remain"][j]),
+        "amount_able_to_be_sold": int(buy["volume_remain"][i]),
+        "margin": float(margin),
+        "potential_revenue": float(potential_revenue),
+        "_buy_system": int(sell["system_id"][j]),
+        "_sell_system": int(buy["system_id"][i]),
+        "buy_system_sec": sell_sec[j],
+        "sell_system_sec": buy_sec[i]
+    }
+
 
+def load_order_store(get_new_orders=False, safe_regions=True, concurrency=u.DEFAULT_CONCURRENCY, history_days=0):
     if get_new_orders:
-        get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions)
-        df = pd.read_csv("./data/orders/orders.csv", quotechar="|")
-        print("\nGetting interim dictionary. This may take a minute..")
-        df_grouped = df.groupby("type_name")
-        df_dict = df_grouped.apply(
-            lambda group: {
-                "buy": {col: group[group["is_buy_order"] == True][col].tolist() for col in group.columns},
-                "sell": {col: group[group["is_buy_order"] == False][col].tolist() for col in group.columns}
-            }
-        ).to_dict()
-        u.write_to_json(df_dict, "./data/orders/orders_by_item.csv")
+        get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions, concurrency=concurrency, history_days=history_days)
+    elif not ost.store_exists():
+        print("No order data saved, but 'get_new_orders' parameter was set to False. Downloading anyway")
+        get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions, concurrency=concurrency, history_days=history_days)
+    print("\nOpening order store at: " + ost.STORE_DIR)
+    return ost.OrderStore()
+
+
+def get_item_opportunities(type_id, book, engine, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, mode="pairs"):
+    if mode == "depth":
+        return get_item_depth_opportunities(type_id, book, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating)
+    if engine == "legacy":
+        scan = sc.scan_item_legacy
+        book = {side: {col: values.tolist() for col, values in book[side].items()} for side in book}
     else:
-        print("\nLoading saved order dictionary at: ./data/orders/orders_by_item.csv")
-        df_dict = u.load_data("./data/orders/orders_by_item.csv")
-        if len(df_dict) == 0:
-            print("No order data saved, but 'get_new_orders' parameter was set to False. Downloading anyway")
-            get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions)
-            df = pd.read_csv("./data/orders/orders.csv", quotechar="|")
-            print("\nGetting interim dictionary. This may take a minute..")
-            df_grouped = df.groupby("type_name")
-            df_dict = df_grouped.apply(
-                lambda group: {
-                    "buy": {col: group[group["is_buy_order"] == True][col].tolist() for col in group.columns},
-                    "sell": {col: group[group["is_buy_order"] == False][col].tolist() for col in group.columns}
-                }
-            ).to_dict()
-            u.write_to_json(df_dict, "./data/orders/orders_by_item.csv")
-
+        scan = sc.scan_item
+
+    item = lookups["types"][str(type_id)]
+    buy = book["buy"]
+    sell = book["sell"]
+    buy_sec = systems.security_of(buy["system_id"]).tolist()
+    sell_sec = systems.security_of(sell["system_id"]).tolist()
+    pairs = scan(buy, sell, buy_sec, sell_sec, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating)
+    rows = []
+    for i, j, margin, potential_revenue in zip(*[_to_list(p) for p in pairs]):
+        rows.append(get_opportunity_row(item, type_id, buy, sell, i, j, margin, potential_revenue, buy_sec, sell_sec, lookups))
+    return rows
+
+
+def get_item_depth_opportunities(type_id, book, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating):
+    item = lookups["types"][str(type_id)]
+    buy = book["buy"]
+    sell = book["sell"]
+    buy_sec = systems.security_of(buy["system_id"]).tolist()
+    sell_sec = systems.security_of(sell["system_id"]).tolist()
+    matches = sc.scan_item_depth(buy, sell, buy_sec, sell_sec, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating)
     rows = []
-    item_count = 0
-    artbitrage_count = 0
-    system_details = get_system_details(system_name_by_system)
-    for item in df_dict.keys():
-        item_count += 1
-        u.overwrite_print("Processing item: " + str(item_count) + "/" + str(len(df_dict.keys())) + ". " + str(artbitrage_count) + " opportunities found so far")
-        for i in range(len(df_dict[item]["buy"]["price"])):
-            if system_details[df_dict[item]["buy"]["system_name"][i]]["security_status"] < min_system_sec_rating:
-                continue
-            for j in range(len(df_dict[item]["sell"]["price"])):
-                if df_dict[item]["sell"]["price"][j] > max_item_purchase_price or system_details[df_dict[item]["sell"]["system_name"][j]]["security_status"] < min_system_sec_rating:
-                    continue
-                if df_dict[item]["buy"]["price"][i] > df_dict[item]["sell"]["price"][j]:
-                    margin = ((df_dict[item]["buy"]["price"][i] / df_dict[item]["sell"]["price"][j]) - 1)*100
-                    if margin >= min_margin:
-                        max_items_could_be_transacted = min(df_dict[item]["sell"]["volume_remain"][j], df_dict[item]["buy"]["volume_remain"][i])
-                        potential_revenue = (max_items_could_be_transacted*df_dict[item]["buy"]["price"][i]) - (max_items_could_be_transacted*df_dict[item]["sell"]["price"][j])
-                        if potential_revenue >= min_potential_revenue:
-                            artbitrage_count += 1
-                            row = {
-                                "item_id": df_dict[item]["sell"]["type_id"][j],
-                                "item": item.replace(",", "-"),
-                                "buy_in_region": df_dict[item]["sell"]["region_name"][j],
-                                "buy_in_system_name": df_dict[item]["sell"]["system_name"][j],
-                                "buy_in_location_id": df_dict[item]["sell"]["location_id"][j],
-                                "sell_in_region": df_dict[item]["buy"]["region_name"][i],
-                                "sell_in_system_name": df_dict[item]["buy"]["system_name"][i],
-                                "sell_in_location_id": df_dict[item]["buy"]["location_id"][i],
-                                "buy_price": df_dict[item]["sell"]["price"][j],
-                                "sell_price": df_dict[item]["buy"]["price"][i],
-                                "buy_min_volume": df_dict[item]["sell"]["min_volume"][j],
-                                "sell_min_volume": df_dict[item]["buy"]["min_volume"][i],
-                                "amount_available_to_buy": df_dict[item]["sell"]["volume_remain"][j],
-                                "amount_able_to_be_sold": df_dict[item]["buy"]["volume_remain"][i],
-                                "margin": margin,
-                                "potential_revenue": potential_revenue,
-                                "_buy_system": df_dict[item]["sell"]["system_id"][j],
-                                "_sell_system": df_dict[item]["buy"]["system_id"][i],
-                                "buy_system_sec": system_details[df_dict[item]["sell"]["system_name"][j]]["security_status"],
-                                "sell_system_sec": system_details[df_dict[item]["buy"]["system_name"][i]]["security_status"]
-                            }
-                            rows.append(row)
-
-    # Get type details only for items with arbitrage opportunities. Saves pulling down 35k items 1 by 1
-    type_ids = list(set([str(row["item_id"]) for row in rows]))
-    type_details = get_type_details(type_name_by_type, type_ids)
-    header = [
-        "item_id", "item", "buy_in_region", "buy_in_system_name", "buy_in_location_id",
-        "sell_in_region", "sell_in_system_name", "sell_in_location_id",
-        "buy_price", "sell_price", "buy_min_volume", "sell_min_volume", "amount_available_to_buy",
-        "amount_able_to_be_sold", "margin", "potential_revenue", "_buy_system", "_sell_system",
-        "buy_system_sec", "sell_system_sec", "item_volume"
-    ]
+    for i, j, quantity, cost, revenue, num_buys, num_sells in zip(*[_to_list(m) for m in matches]):
+        row = get_opportunity_row(item, type_id, buy, sell, i, j, ((revenue / cost) - 1)*100, revenue - cost, buy_sec, sell_sec, lookups)
+        row["buy_price"] = cost / quantity
+        row["sell_price"] = revenue / quantity
+        row["amount_available_to_buy"] = quantity
+        row["amount_able_to_be_sold"] = quantity
+        row["orders_to_buy_from"] = num_sells
+        row["orders_to_sell_to"] = num_buys
+        rows.append(row)
+    return rows
+
+
+def add_opportunity_details(rows, lookups, systems, min_potential_revenue, single_cargo=True, cargo_capacity=0, get_routes=True, route_engine="local", concurrency=u.DEFAULT_CONCURRENCY, mode="pairs"):
+    # Only items with opportunities are needed. Their details are usually already saved by the prefetch when orders were refreshed
+    type_ids = list(set([row["item_id"] for row in rows]))
+    type_details = get_type_details(lookups["types"], type_ids, concurrency)
+    header = list(OPPORTUNITY_HEADER)
+    if mode == "depth":
+        header += DEPTH_HEADER
     for row in rows:
-        row["item_volume"] = type_details[row["item"]]["packaged_volume"]
+        row["item_volume"] = type_details[row["item_id"]]["packaged_volume"]
 
     single_cargo_rows = []
     if single_cargo:
@@ -296,13 +390,334 @@ def get_pure_arbitrage(min_margin, max_item_purchase_price, min_potential_revenu
         header.append("route")
         header.append("route_jumps")
         od_pairs = list(set([(row["_buy_system"], row["_sell_system"], row["buy_in_system_name"], row["sell_in_system_name"]) for row in rows]))
-        route_by_od_pair = get_routes_by_od_pairs(od_pairs)
+        if route_engine == "esi":
+            route_by_od_pair = get_routes_by_od_pairs(od_pairs)
+        else:
+            route_by_od_pair = get_local_routes_by_od_pairs(od_pairs, systems)
         for row in rows:
             route = route_by_od_pair[(row["_buy_system"], row["_sell_system"], row["buy_in_system_name"], row["sell_in_system_name"])]
             row["route"] = '-'.join([str(i) for i in route])
             row["route_jumps"] = len(route)
 
-    u.write_to_csv(header,rows,"./output/pure_arbitrage.csv")
+    return header, rows
+
+
+def scan_store(store, engine, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, workers=1, mode="pairs", ranking=None):
+    # With a ranking, only its top opportunities are kept as the scan goes, best first
+    scan_args = (engine, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, mode)
+    num_items = len(store.type_ids)
+    rows = []
+    num_found = 0
+    metrics.increment("scan.items", num_items)
+    if workers <= 1:
+        for item_index, type_id in enumerate(store.type_ids.tolist()):
+            u.overwrite_print("Processing item: " + str(item_index + 1) + "/" + str(num_items) + ". " + str(num_found) + " opportunities found so far")
+            item_rows = get_item_opportunities(type_id, store.book(type_id, ORDER_COLUMNS), *scan_args)
+            num_found += len(item_rows)
+            if ranking is None:
+                rows += item_rows
+            else:
+                rank_opportunities(ranking, item_index, item_rows, rows)
+        return rows if ranking is None else get_ranked_rows(rows)
+
+    # Each worker memory maps the store itself, so the order arrays are shared through the page cache rather than copied.
+    # Shards hold roughly equal numbers of orders and come back in order, so the rows are the same as a single process scan
+    shards = get_scan_shards(store, workers*SHARDS_PER_WORKER)
+    print("\nScanning " + str(num_items) + " items in " + str(len(shards)) + " shards across " + str(workers) + " workers")
+    pool = multiprocessing.Pool(workers, initializer=_init_scan_worker, initargs=(store.path, scan_args, ranking))
+    try:
+        for shard_count, (shard_found, shard_rows, shard_metrics) in enumerate(pool.imap(_scan_shard, shards)):
+            num_found += shard_found
+            metrics.merge(shard_metrics)
+            if ranking is None:
+                rows += shard_rows
+            else:
+                for entry in shard_rows:
+                    push_ranked(rows, entry, ranking["top"])
+            u.overwrite_print("Processed shard: " + str(shard_count + 1) + "/" + str(len(shards)) + ". " + str(num_found) + " opportunities found so far")
+    finally:
+        pool.close()
+        pool.join()
+    return rows if ranking is None else get_ranked_rows(rows)
+
+
+def get_scan_shards(store, num_shards):
+    # Ranges of positions in store.type_ids
+    cuts = np.searchsorted(store.offsets[:-1], np.linspace(0, len(store), num_shards + 1)[1:-1])
+    bounds = np.unique(np.concatenate(([0], cuts, [len(store.type_ids)])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+_scan_worker = {}
+
+
+def _init_scan_worker(store_path, scan_args, ranking):
+    _scan_worker["store"] = ost.OrderStore(store_path)
+    _scan_worker["scan_args"] = scan_args
+    _scan_worker["ranking"] = ranking
+
+
+def _scan_shard(shard):
+    # Workers count into their own copy of the metrics. Each shard sends back what it added for the parent to merge
+    metrics.reset()
+    store = _scan_worker["store"]
+    ranking = _scan_worker["ranking"]
+    rows = []
+    num_found = 0
+    for item_index in range(shard[0], shard[1]):
+        type_id = int(store.type_ids[item_index])
+        item_rows = get_item_opportunities(type_id, store.book(type_id, ORDER_COLUMNS), *_scan_worker["scan_args"])
+        num_found += len(item_rows)
+        if ranking is None:
+            rows += item_rows
+        else:
+            rank_opportunities(ranking, item_index, item_rows, rows)
+    return num_found, rows, metrics.snapshot()
+
+
+def get_ranking(top, rank_by, jumps_per_minute, single_cargo, cargo_capacity, min_potential_revenue, type_details, systems):
+    ranking = {
+        "top": top,
+        "rank_by": rank_by,
+        "jumps_per_minute": jumps_per_minute,
+        "single_cargo": single_cargo,
+        "cargo_capacity": cargo_capacity,
+        "min_potential_revenue": min_potential_revenue,
+        "volume_by_type": {type_id: details["packaged_volume"] for type_id, details in type_details.items()},
+        "jumps": None
+    }
+    if rank_by != "profit_per_cargo":
+        ranking["jumps"] = rt.JumpCounter(systems.jump_graph())
+    return ranking
+
+
+def get_opportunity_score(row, ranking):
+    # Same cargo limit add_opportunity_details applies, just early enough that rows which fail it are never kept
+    profit = row["potential_revenue"]
+    if ranking["single_cargo"]:
+        item_volume = ranking["volume_by_type"].get(row["item_id"])
+        if item_volume is None:
+            return None
+        profit = min((row["sell_price"] - row["buy_price"])*ranking["cargo_capacity"] / item_volume, row["potential_revenue"])
+        if profit <= ranking["min_potential_revenue"]:
+            return None
+    if ranking["rank_by"] == "profit_per_cargo":
+        return profit
+
+    jumps = ranking["jumps"](row["_buy_system"], row["_sell_system"])
+    if jumps < 0:
+        return None
+    if ranking["rank_by"] == "profit_per_jump":
+        return profit / max(jumps, 1)
+    # isk_per_hour: one trip from the buy system to the sell system
+    return profit / (max(jumps, 1) / ranking["jumps_per_minute"] / 60.0)
+
+
+def rank_opportunities(ranking, item_index, rows, heap):
+    for row_index, row in enumerate(rows):
+        score = get_opportunity_score(row, ranking)
+        if score is not None:
+            row[ranking["rank_by"]] = score
+            # Ties go to whichever the scan found first, so the result doesn't depend on how items were sharded
+            push_ranked(heap, (score, -item_index, -row_index, row), ranking["top"])
+
+
+def push_ranked(heap, entry, top):
+    if len(heap) < top:
+        heapq.heappush(heap, entry)
+    elif entry[:3] > heap[0][:3]:
+        heapq.heapreplace(heap, entry)
+
+
+def get_ranked_rows(heap):
+    return [entry[3] for entry in sorted(heap, key=lambda entry: entry[:3], reverse=True)]
+
+
+def get_pure_arbitrage(min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, single_cargo=True, cargo_capacity=0, get_routes=True, get_new_orders=False, get_new_lookups=False, safe_regions=True, engine="vectorized", concurrency=u.DEFAULT_CONCURRENCY, route_engine="local", workers=1, mode="pairs", top=0, rank_by="profit_per_cargo", jumps_per_minute=1.0, profile=False, report=metrics.REPORT_FILE, as_of=None, max_jumps=0, history_days=0):
+
+    if single_cargo and cargo_capacity == 0:
+        print("Please provide a cargo capacity")
+        return
+
+    metrics.reset()
+    # can't force another download of the lookups. Assumes they've been saved in get_and_save_orders()
+    with metrics.stage("lookups"):
+        lookups = get_name_lookups(force=get_new_lookups, concurrency=concurrency)
+    system_name_by_system = lookups["systems"]
+
+    with metrics.stage("orders"):
+        if as_of is None:
+            store = load_order_store(get_new_orders, safe_regions, concurrency, history_days)
+        else:
+            # Backtesting against the order books as they were then. Nothing is downloaded
+            print("\nRestoring orders as of " + hist.format_time(as_of) + " to " + hist.RESTORED_DIR)
+            store = hist.restore(as_of)
+
+    with metrics.stage("system_details"):
+        systems = get_system_index(system_name_by_system, concurrency)
+    ranking = None
+    scan_mode = mode
+    scan_min_potential_revenue = min_potential_revenue
+    if mode == "hub":
+        # Hauls are built from the whole order book matches between stations. Items that don't make enough on their
+        # own are kept, since a haul can make up the rest with other items going the same way
+        scan_mode = "depth"
+        scan_min_potential_revenue = 0
+    elif top > 0:
+        # Volumes are needed up front so the cargo limit can be applied while scanning
+        with metrics.stage("ranking"):
+            type_details = get_type_details(lookups["types"], store.type_ids.tolist(), concurrency)
+            ranking = get_ranking(top, rank_by, jumps_per_minute, single_cargo, cargo_capacity, min_potential_revenue, type_details, systems)
+        print("\nKeeping the top " + str(top) + " opportunities by " + rank_by)
+    scan_args = (store, engine, systems, lookups, min_margin, max_item_purchase_price, scan_min_potential_revenue, min_system_sec_rating, workers, scan_mode, ranking)
+    with metrics.stage("scan"):
+        if profile:
+            rows = metrics.profile(metrics.PROFILE_FILE, scan_store, *scan_args)
+        else:
+            rows = scan_store(*scan_args)
+    metrics.increment("opportunities.found", len(rows))
+
+    with metrics.stage("enrich"):
+        if mode == "hub":
+            header, rows = get_hub_hauls(rows, lookups, systems, single_cargo, cargo_capacity, min_potential_revenue, max_jumps, top, concurrency)
+        else:
+            header, rows = add_opportunity_details(rows, lookups, systems, min_potential_revenue, single_cargo, cargo_capacity, get_routes, route_engine, concurrency, mode)
+    if ranking is not None:
+        header.append(rank_by)
+    metrics.increment("opportunities.written", len(rows))
+    with metrics.stage("write"):
+        u.write_to_csv(header,rows,"./output/pure_arbitrage.csv")
+
+    if report:
+        metrics.write_report(report, {
+            "min_margin": min_margin,
+            "max_item_purchase_price": max_item_purchase_price,
+            "min_potential_revenue": min_potential_revenue,
+            "min_system_sec_rating": min_system_sec_rating,
+            "single_cargo": single_cargo,
+            "cargo_capacity": cargo_capacity,
+            "get_routes": get_routes,
+            "get_new_orders": get_new_orders,
+            "safe_regions": safe_regions,
+            "engine": engine,
+            "route_engine": route_engine,
+            "workers": workers,
+            "mode": mode,
+            "top": top,
+            "rank_by": rank_by,
+            "max_jumps": max_jumps,
+            "as_of": as_of,
+            "history_days": history_days,
+            "orders": len(store),
+            "items": len(store.type_ids)
+        })
+
+
+def get_hub_hauls(rows, lookups, systems, single_cargo=True, cargo_capacity=0, min_potential_revenue=0, max_jumps=0, top=0, concurrency=u.DEFAULT_CONCURRENCY):
+    type_details = get_type_details(lookups["types"], list(set([row["item_id"] for row in rows])), concurrency)
+    for row in rows:
+        row["item_volume"] = type_details[row["item_id"]]["packaged_volume"]
+    od_pairs = sorted(set([(row["_buy_system"], row["_sell_system"]) for row in rows]))
+    print("\nCounting jumps from " + str(len(set([od_pair[0] for od_pair in od_pairs]))) + " systems for " + str(len(od_pairs)) + " origin-destination pairs")
+    with metrics.timer("routes.local"):
+        jumps_by_od_pair = hl.get_jumps_by_od_pair(systems.jump_graph(), od_pairs)
+    hauls = hl.get_hauls(rows, jumps_by_od_pair, cargo_capacity if single_cargo else 0, min_potential_revenue, max_jumps)
+    print("\nFound " + str(len(hauls)) + " hauls making > " + str(min_potential_revenue))
+    if top > 0:
+        hauls = hauls[:top]
+    return list(hl.HAUL_HEADER), hauls
+
+
+def get_types_by_region(store):
+    region = store.column("region")
+    type_id = store.column("type_id")
+    return {r: set(np.unique(type_id[region == r]).tolist()) for r in store.regions()}
+
+
+def get_opportunity_key(row):
+    return (row["item_id"], row["buy_in_location_id"], row["sell_in_location_id"], row["buy_price"], row["sell_price"])
+
+
+def get_next_refresh(region_name_by_region, safe_regions=True):
+    regions, urls, filelocs = get_order_sources(region_name_by_region, safe_regions)
+    expires = [meta["expires"] for meta in [u.load_page_meta(fileloc) for fileloc in filelocs] if meta is not None]
+    if len(expires) == 0:
+        return time.time() + MIN_WATCH_SLEEP
+    return max(min(expires), time.time() + MIN_WATCH_SLEEP)
+
+
+def watch_pure_arbitrage(min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, single_cargo=True, cargo_capacity=0, get_routes=True, get_new_orders=False, get_new_lookups=False, safe_regions=True, engine="vectorized", concurrency=u.DEFAULT_CONCURRENCY, route_engine="local", mode="pairs", history_days=0, report=metrics.REPORT_FILE):
+
+    if single_cargo and cargo_capacity == 0:
+        print("Please provide a cargo capacity")
+        return
+    if mode == "hub":
+        print("--mode hub isn't supported with --watch")
+        return
+
+    lookups = get_name_lookups(force=get_new_lookups, concurrency=concurrency)
+    systems = get_system_index(lookups["systems"], concurrency)
+    store = load_order_store(get_new_orders, safe_regions, concurrency, history_days)
+    types_by_region = get_types_by_region(store)
+
+    # Opportunities stay in memory between refreshes. Only items whose orders changed get rescanned
+    rows_by_type = {}
+    changed_types = store.type_ids.tolist()
+    first_scan = True
+    try:
+        while True:
+            print("\nScanning " + str(len(changed_types)) + " items with changed orders")
+            rows = []
+            metrics.increment("scan.items", len(changed_types))
+            with metrics.stage("scan"):
+                for type_id in changed_types:
+                    start, end = store.item_range(type_id)
+                    if start == end:
+                        continue
+                    rows += get_item_opportunities(type_id, store.book(type_id, ORDER_COLUMNS), engine, systems, lookups, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating, mode)
+            with metrics.stage("enrich"):
+                header, rows = add_opportunity_details(rows, lookups, systems, min_potential_revenue, single_cargo, cargo_capacity, get_routes, route_engine, concurrency, mode)
+
+            old_rows = [row for type_id in changed_types for row in rows_by_type.pop(type_id, [])]
+            for row in rows:
+                rows_by_type.setdefault(row["item_id"], []).append(row)
+            new_keys = set(get_opportunity_key(row) for row in rows)
+            old_keys = set(get_opportunity_key(row) for row in old_rows)
+            changes = [dict(row, change="new") for row in rows if get_opportunity_key(row) not in old_keys]
+            changes += [dict(row, change="vanished") for row in old_rows if get_opportunity_key(row) not in new_keys]
+
+            seen_at = time.strftime("%Y-%m-%d %H:%M:%S")
+            all_rows = [row for type_id in sorted(rows_by_type) for row in rows_by_type[type_id]]
+            u.write_to_csv(header, all_rows, "./output/pure_arbitrage.csv")
+            if not first_scan:
+                for row in changes:
+                    row["seen_at"] = seen_at
+                u.write_to_csv(["seen_at", "change"] + header, changes, "./output/pure_arbitrage_changes.csv", append=True)
+            print("\n" + seen_at + ": " + str(len(all_rows)) + " opportunities. " + str(len([c for c in changes if c["change"] == "new"])) + " new, " + str(len([c for c in changes if c["change"] == "vanished"])) + " vanished")
+            first_scan = False
+            # One report per refresh, covering the download that triggered it and the rescan
+            metrics.increment("opportunities.written", len(all_rows))
+            if report:
+                metrics.write_report(report, {"watch": True, "engine": engine, "mode": mode, "seen_at": seen_at, "changes": len(changes)})
+            metrics.reset()
+
+            changed_regions = []
+            while len(changed_regions) == 0:
+                next_refresh = get_next_refresh(lookups["regions"], safe_regions)
+                print("Next refresh at " + time.strftime("%H:%M:%S", time.localtime(next_refresh)))
+                time.sleep(max(0, next_refresh - time.time()))
+                with metrics.stage("orders"):
+                    changed_regions = get_and_save_orders(force=True, force_lookups=False, safe_regions=safe_regions, concurrency=concurrency, history_days=history_days)
+
+            store = ost.OrderStore()
+            new_types_by_region = get_types_by_region(store)
+            changed_types = set()
+            for region in changed_regions:
+                changed_types |= types_by_region.get(region, set()) | new_types_by_region.get(region, set())
+            changed_types = sorted(changed_types)
+            types_by_region = new_types_by_region
+    except KeyboardInterrupt:
+        print("\nStopped watching")
 
 
 if __name__ == "__main__":
@@ -313,13 +728,30 @@ if __name__ == "__main__":
     parser.add_argument('--min_system_sec_rating', default=0.5, type=float, help='Limits results to those where both the buy and sell systems have security statuses >= value')
     parser.add_argument('--single_cargo', type=u.str2bool, nargs="?", const=True, default=True, help='Default True. If True, requires cargo_capacity param to be > 0. If True, limits results to those where >= min_potential_revenue can be made from one cargo hold of the given item in the opportunity')
     parser.add_argument('--cargo_capacity', default=0, type=float, help='The cargo capacity to limit each opportunity to')
-    parser.add_argument('--get_routes', type=u.str2bool, nargs="?", const=True, default=True, help='WARNING: Can vastly increase run time. Routes will be saved however. First run time might be slow. If True, finds the route between the buy/sell system and adds the # of jumps to the results')
-    parser.add_argument('--get_new_orders', type=u.str2bool, nargs="?", const=True, default=True, help='If True, downloads new orders and saves them to the filesystem prior to finding arbitrage opportunities. Can take ~1h')
+    parser.add_argument('--get_routes', type=u.str2bool, nargs="?", const=True, default=True, help='If True, finds the route between the buy/sell system and adds the # of jumps to the results')
+    parser.add_argument('--get_new_orders', type=u.str2bool, nargs="?", const=True, default=True, help='If True, downloads new orders and saves them to the filesystem prior to finding arbitrage opportunities. Pages are fetched --concurrency at a time and regions still in the ESI cache are skipped')
     parser.add_argument('--get_new_lookups', type=u.str2bool, nargs="?", const=False, default=False, help='If True, downloads new region/system/item names. Only set to True if you know new systems/regions/item names may have been added to the game. Rare.')
     parser.add_argument('--safe_regions', type=u.str2bool, nargs="?", const=True, default=True, help='Default True. Used in conjunction with get_new_orders. If True, only downloads results from regions in Cal/Gal/Min/Amarr space. See code for list.')
+    parser.add_argument('--engine', default="vectorized", choices=["vectorized", "legacy"], help='Default vectorized. Arbitrage scan to use. "legacy" runs the original buy/sell nested loop, useful for comparing results')
+    parser.add_argument('--concurrency', default=u.DEFAULT_CONCURRENCY, type=int, help='Default ' + str(u.DEFAULT_CONCURRENCY) + '. Max number of ESI requests in flight at once when downloading orders and lookups')
+    parser.add_argument('--route_engine', default="local", choices=["local", "esi"], help='Default local. "local" finds routes on a jump graph built from the saved system and stargate details. "esi" asks ESI for every route one at a time, which can vastly increase run time')
+    parser.add_argument('--watch', type=u.str2bool, nargs="?", const=True, default=False, help='Default False. If True, keeps running. Orders are refreshed as each region expires from the ESI cache, only items whose orders changed are rescanned, and new/vanished opportunities are appended to ./output/pure_arbitrage_changes.csv')
+    parser.add_argument('--workers', default=1, type=int, help='Default 1. Number of processes to split the arbitrage scan across. Items are sharded between them')
+    parser.add_argument('--mode', default="pairs", choices=["pairs", "depth", "hub"], help='Default pairs. pairs lists every profitable buy/sell order pair. depth matches the whole order book between each pair of stations and lists one opportunity per item and station pair. hub fills one cargo hold per pair of systems with every item worth hauling between them and ranks the hauls by ISK per jump')
+    parser.add_argument('--max_jumps', default=0, type=int, help='Default 0 (no limit). With --mode hub, only hauls of at most this many jumps are kept')
+    parser.add_argument('--top', default=0, type=int, help='Default 0 (off). If > 0, only the best K opportunities are kept while scanning and written out, best first')
+    parser.add_argument('--rank_by', default="profit_per_cargo", choices=["profit_per_cargo", "profit_per_jump", "isk_per_hour"], help='Default profit_per_cargo. What --top ranks opportunities by')
+    parser.add_argument('--jumps_per_minute', default=1.0, type=float, help='Default 1.0. How many jumps a trip makes per minute, used to rank by isk_per_hour')
+    parser.add_argument('--profile', type=u.str2bool, nargs="?", const=True, default=False, help='Default False. If True, runs the arbitrage scan under cProfile and saves the stats to ' + metrics.PROFILE_FILE)
+    parser.add_argument('--as_of', default=None, type=hist.parse_time, help='Default None. Finds opportunities in the saved order snapshot from this time instead of the current orders, e.g. "2018-06-01 12:00:00". Nothing is downloaded')
+    parser.add_argument('--history_days', default=0, type=float, help='Default 0 (off). If > 0, a snapshot of the orders is saved after every refresh for --as_of and history.py, and snapshots older than this many days are deleted')
+    parser.add_argument('--report', default=metrics.REPORT_FILE, help='Default ' + metrics.REPORT_FILE + '. Where to write the JSON run report with stage timings and counters. Set to an empty string to skip it')
     args = parser.parse_args()
 
     if u.directories_exist() == False:
         u.create_folder_structure()
 
-    get_pure_arbitrage(args.min_margin, args.max_item_purchase_price, args.min_potential_revenue, args.min_system_sec_rating, args.single_cargo, args.cargo_capacity, args.get_routes, args.get_new_orders, args.get_new_lookups, args.safe_regions)
+    if args.watch:
+        watch_pure_arbitrage(args.min_margin, args.max_item_purchase_price, args.min_potential_revenue, args.min_system_sec_rating, args.single_cargo, args.cargo_capacity, args.get_routes, args.get_new_orders, args.get_new_lookups, args.safe_regions, args.engine, args.concurrency, args.route_engine, args.mode, args.history_days, args.report)
+    else:
+        get_pure_arbitrage(args.min_margin, args.max_item_purchase_price, args.min_potential_revenue, args.min_system_sec_rating, args.single_cargo, args.cargo_capacity, args.get_routes, args.get_new_orders, args.get_new_lookups, args.safe_regions, args.engine, args.concurrency, args.route_engine, args.workers, args.mode, args.top, args.rank_by, args.jumps_per_minute, args.profile, args.report, args.as_of, args.max_jumps, args.history_days)
@@ -0,0 +1,231 @@
+import numpy as np
+import utils as u
+import metadata as md
+
+# ESI rounds security to one decimal place, so anything >= 0.45 shows up as high sec
+HIGH_SEC = 0.45
+
+# Origins whose searches a JumpCounter keeps at once. Each one is a jump count for every system
+MAX_CACHED_ORIGINS = 256
+
+
+def get_stargate_destinations(system_details, concurrency=u.DEFAULT_CONCURRENCY):
+    store = md.get_store()
+    stargates = [stargate for details in system_details.values() for stargate in details.get("stargates", [])]
+    missing = store.missing("stargates", stargates)
+    if len(missing) > 0:
+        print("\nGetting destinations for " + str(len(missing)) + " stargates")
+        urls = [u.ESI_URL + "/universe/stargates/" + str(stargate) + "/?datasource=tranquility" for stargate in missing]
+        fetched = {}
+        for stargate, data in zip(missing, u.download_many(urls, concurrency)):
+            if md.is_valid(data) and "destination" in data:
+                fetched[stargate] = data
+        store.put_many("stargates", fetched)
+    return {stargate: data["destination"]["system_id"] for stargate, data in store.get_many("stargates", stargates).items()}
+
+
+def build_system_index(system_details, constellation_details, concurrency=u.DEFAULT_CONCURRENCY):
+    # Everything the scan and routing need per system, as plain lists so it can be compiled next to the system names.
+    # Neighbours are compressed sparse rows: those of system k are neighbours[neighbour_indptr[k]:neighbour_indptr[k + 1]].
+    # complete is False if any system, constellation or stargate details are missing, e.g. because a download failed
+    destinations = get_stargate_destinations(system_details, concurrency=concurrency)
+    index = {
+        "system_ids": [],
+        "security": [],
+        "constellation_ids": [],
+        "region_ids": [],
+        "neighbour_indptr": [0],
+        "neighbours": [],
+        "complete": True
+    }
+    for system_id in sorted(system_details):
+        details = system_details[system_id]
+        constellation_id = details.get("constellation_id", -1)
+        stargates = details.get("stargates", [])
+        if constellation_id not in constellation_details or any(stargate not in destinations for stargate in stargates):
+            index["complete"] = False
+        index["system_ids"].append(details["system_id"])
+        index["security"].append(details["security_status"])
+        index["constellation_ids"].append(constellation_id)
+        index["region_ids"].append(constellation_details.get(constellation_id, {}).get("region_id", -1))
+        index["neighbours"] += sorted(set(destinations[stargate] for stargate in stargates if stargate in destinations))
+        index["neighbour_indptr"].append(len(index["neighbours"]))
+    return index
+
+
+class SystemIndex(object):
+    # Dense arrays sorted by system_id, so looking up a whole order book's systems is one binary search over arrays
+
+    def __init__(self, index):
+        self.system_ids = np.asarray(index["system_ids"], dtype=np.int64)
+        self.security = np.asarray(index["security"], dtype=np.float64)
+        self.constellation_ids = np.asarray(index["constellation_ids"], dtype=np.int64)
+        self.region_ids = np.asarray(index["region_ids"], dtype=np.int64)
+        self.neighbour_indptr = np.asarray(index["neighbour_indptr"], dtype=np.int64)
+        self.neighbours = np.asarray(index["neighbours"], dtype=np.int64)
+        self._graph = None
+
+    def __len__(self):
+        return len(self.system_ids)
+
+    def _lookup(self, values, system_ids, missing):
+        system_ids = np.asarray(system_ids, dtype=np.int64)
+        if len(self.system_ids) == 0:
+            return np.full(system_ids.shape, missing, dtype=values.dtype)
+        positions = np.minimum(np.searchsorted(self.system_ids, system_ids), len(self.system_ids) - 1)
+        return np.where(self.system_ids[positions] == system_ids, values[positions], missing)
+
+    def security_of(self, system_ids):
+        # NaN for systems without details, which no security filter lets through
+        return self._lookup(self.security, system_ids, np.nan)
+
+    def region_of(self, system_ids):
+        return self._lookup(self.region_ids, system_ids, -1)
+
+    def constellation_of(self, system_ids):
+        return self._lookup(self.constellation_ids, system_ids, -1)
+
+    def jump_graph(self):
+        if self._graph is None:
+            sources = self.system_ids.repeat(np.diff(self.neighbour_indptr))
+            self._graph = JumpGraph(self.system_ids, self.security, np.column_stack((sources, self.neighbours)))
+        return self._graph
+
+
+class JumpGraph(object):
+
+    def __init__(self, system_ids, security, jumps):
+        order = np.argsort(system_ids)
+        self.system_ids = np.asarray(system_ids, dtype=np.int64)[order]
+        self.security = np.asarray(security, dtype=np.float64)[order]
+        self.high_sec = self.security >= HIGH_SEC
+
+        # Compressed sparse row adjacency: the neighbours of system k are indices[indptr[k]:indptr[k + 1]]
+        jumps = np.asarray(jumps, dtype=np.int64).reshape(-1, 2)
+        known = np.isin(jumps[:, 0], self.system_ids) & np.isin(jumps[:, 1], self.system_ids)
+        src = self.index_of(jumps[known, 0])
+        dst = self.index_of(jumps[known, 1])
+        edges = np.unique(src*len(self.system_ids) + dst)
+        src, dst = np.divmod(edges, len(self.system_ids))
+        self.indptr = np.searchsorted(src, np.arange(len(self.system_ids) + 1)).astype(np.int64)
+        self.indices = dst.astype(np.int32)
+
+    def __len__(self):
+        return len(self.system_ids)
+
+    def index_of(self, system_ids):
+        return np.searchsorted(self.system_ids, system_ids)
+
+    def _neighbours(self, frontier):
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        offsets = np.cumsum(counts) - counts
+        positions = np.arange(counts.sum()) - offsets.repeat(counts) + starts.repeat(counts)
+        return self.indices[positions], frontier.repeat(counts)
+
+    def bfs(self, source, allowed=None):
+        # Level by level breadth first search from one system index. Returns jumps and predecessor per system, -1 where unreachable
+        distance = np.full(len(self), -1, dtype=np.int32)
+        parent = np.full(len(self), -1, dtype=np.int32)
+        distance[source] = 0
+        frontier = np.array([source], dtype=np.int64)
+        level = 0
+        while len(frontier) > 0:
+            level += 1
+            neighbours, parents = self._neighbours(frontier)
+            unseen = distance[neighbours] == -1
+            if allowed is not None:
+                unseen &= allowed[neighbours]
+            neighbours, first = np.unique(neighbours[unseen], return_index=True)
+            distance[neighbours] = level
+            parent[neighbours] = parents[unseen][first]
+            frontier = neighbours
+        return distance, parent
+
+    def routes_from(self, origin_id, destination_ids, secure=True):
+        origin = self.index_of(origin_id)
+        parent = self.bfs(origin, self.high_sec if secure else None)[1]
+        fallback = None
+        routes = {}
+        for destination_id in destination_ids:
+            destination = self.index_of(destination_id)
+            route = self._path(parent, origin, destination)
+            if len(route) == 0 and secure:
+                # Nothing stays in high sec, so fall back to the shortest route like ESI does
+                if fallback is None:
+                    fallback = self.bfs(origin)[1]
+                route = self._path(fallback, origin, destination)
+            routes[destination_id] = route
+        return routes
+
+    def _path(self, parent, origin, destination):
+        if destination != origin and parent[destination] == -1:
+            return []
+        path = [destination]
+        while path[-1] != origin:
+            path.append(parent[path[-1]])
+        return self.system_ids[path[::-1]].tolist()
+
+    def route(self, origin_id, destination_id, secure=True):
+        return self.routes_from(origin_id, [destination_id], secure)[destination_id]
+
+    def routes(self, od_pairs, secure=True):
+        # One search per distinct origin answers every pair that starts there
+        destinations_by_origin = {}
+        for origin_id, destination_id in od_pairs:
+            destinations_by_origin.setdefault(origin_id, []).append(destination_id)
+        route_by_od_pair = {}
+        for origin_id, destination_ids in destinations_by_origin.items():
+            for destination_id, route in self.routes_from(origin_id, destination_ids, secure).items():
+                route_by_od_pair[(origin_id, destination_id)] = route
+        return route_by_od_pair
+
+    def jumps_from(self, origin_id, secure=True):
+        # Jumps to every system along the same routes routes_from picks. -1 where unreachable
+        origin = self.index_of(origin_id)
+        distance = self.bfs(origin)[0]
+        if secure:
+            high_sec_distance = self.bfs(origin, self.high_sec)[0]
+            distance = np.where(high_sec_distance >= 0, high_sec_distance, distance)
+        return distance
+
+    def distances(self, origin_ids, secure=False, allowed=None):
+        # Jumps from each origin to every system, one row per origin. -1 where unreachable.
+        # Every origin is searched at once, a level at a time, so thousands of origins cost a few array passes per jump
+        if allowed is None and secure:
+            allowed = self.high_sec
+        num_systems = len(self)
+        matrix = np.full((len(origin_ids), num_systems), -1, dtype=np.int16)
+        frontier_rows = np.arange(len(origin_ids), dtype=np.int64)
+        frontier = np.asarray(self.index_of(origin_ids), dtype=np.int64)
+        matrix[frontier_rows, frontier] = 0
+        level = 0
+        while len(frontier) > 0:
+            level += 1
+            counts = self.indptr[frontier + 1] - self.indptr[frontier]
+            neighbours = self._neighbours(frontier)[0]
+            neighbour_rows = frontier_rows.repeat(counts)
+            unseen = matrix[neighbour_rows, neighbours] == -1
+            if allowed is not None:
+                unseen &= allowed[neighbours]
+            keys = np.unique(neighbour_rows[unseen]*num_systems + neighbours[unseen])
+            frontier_rows, frontier = np.divmod(keys, num_systems)
+            matrix[frontier_rows, frontier] = level
+        return matrix
+
+
+class JumpCounter(object):
+    # Jumps between two systems, remembering the searches from recent origins since most pairs share a few trade hubs
+
+    def __init__(self, graph, secure=True, max_origins=MAX_CACHED_ORIGINS):
+        self.graph = graph
+        self.secure = secure
+        self.max_origins = max_origins
+        self._jumps_by_origin = {}
+
+    def __call__(self, origin_id, destination_id):
+        if origin_id not in self._jumps_by_origin:
+            if len(self._jumps_by_origin) >= self.max_origins:
+                self._jumps_by_origin.clear()
+            self._jumps_by_origin[origin_id] = self.graph.jumps_from(origin_id, self.secure)
+        return int(self._jumps_by_origin[origin_id][self.graph.index_of(destination_id)])
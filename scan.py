@@ -0,0 +1,220 @@
+import numpy as np
+import metrics
+
+# Max number of candidate pairs materialised at once when sweeping a single item
+PAIR_CHUNK_SIZE = 1 << 20
+
+
+def scan_item_legacy(buy, sell, buy_sec, sell_sec, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating):
+    metrics.increment("scan.pairs_possible", len(buy["price"])*len(sell["price"]))
+    metrics.increment("scan.pairs_checked", len(buy["price"])*len(sell["price"]))
+    buy_idx, sell_idx, margins, revenues = [], [], [], []
+    for i in range(len(buy["price"])):
+        # Written as not >= so systems with unknown (NaN) security are skipped, like the vectorized scan does
+        if not (buy_sec[i] >= min_system_sec_rating):
+            continue
+        for j in range(len(sell["price"])):
+            if sell["price"][j] > max_item_purchase_price or not (sell_sec[j] >= min_system_sec_rating):
+                continue
+            if buy["price"][i] > sell["price"][j]:
+                margin = ((buy["price"][i] / sell["price"][j]) - 1)*100
+                if margin >= min_margin:
+                    max_items_could_be_transacted = min(sell["volume_remain"][j], buy["volume_remain"][i])
+                    potential_revenue = (max_items_could_be_transacted*buy["price"][i]) - (max_items_could_be_transacted*sell["price"][j])
+                    if potential_revenue >= min_potential_revenue:
+                        buy_idx.append(i)
+                        sell_idx.append(j)
+                        margins.append(margin)
+                        revenues.append(potential_revenue)
+    metrics.increment("scan.pairs_emitted", len(buy_idx))
+    return buy_idx, sell_idx, margins, revenues
+
+
+def scan_item(buy, sell, buy_sec, sell_sec, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating):
+    buy_price = np.asarray(buy["price"], dtype=np.float64)
+    sell_price = np.asarray(sell["price"], dtype=np.float64)
+    buy_volume = np.asarray(buy["volume_remain"], dtype=np.int64)
+    sell_volume = np.asarray(sell["volume_remain"], dtype=np.int64)
+    metrics.increment("scan.pairs_possible", len(buy_price)*len(sell_price))
+
+    # Pre-filter each side on its own before pairing anything up
+    buy_keep = np.flatnonzero(np.asarray(buy_sec, dtype=np.float64) >= min_system_sec_rating)
+    sell_keep = np.flatnonzero(
+        (sell_price <= max_item_purchase_price) &
+        (np.asarray(sell_sec, dtype=np.float64) >= min_system_sec_rating)
+    )
+    if len(buy_keep) == 0 or len(sell_keep) == 0:
+        return _empty_result()
+
+    # Sells ascending, buys descending. For each buy the qualifying sells are then a prefix of the sell side
+    sell_keep = sell_keep[np.argsort(sell_price[sell_keep], kind="mergesort")]
+    buy_keep = buy_keep[np.argsort(-buy_price[buy_keep], kind="mergesort")]
+    sorted_sell_price = sell_price[sell_keep]
+    sorted_buy_price = buy_price[buy_keep]
+
+    counts = np.searchsorted(sorted_sell_price, sorted_buy_price, side="left")
+    if min_margin > 0:
+        # Loose upper bound on the sell price from the margin. The exact check happens below
+        max_sell_price = sorted_buy_price / (1 + min_margin/100.0) * (1 + 1e-9)
+        counts = np.minimum(counts, np.searchsorted(sorted_sell_price, max_sell_price, side="right"))
+
+    # Buys are descending so once one crosses no sells, none of the following ones will either
+    num_crossing = np.count_nonzero(counts)
+    if num_crossing == 0:
+        return _empty_result()
+    counts = counts[:num_crossing]
+    buy_keep = buy_keep[:num_crossing]
+    metrics.increment("scan.pairs_checked", int(counts.sum()))
+
+    results = []
+    for start, end in _chunk_bounds(counts, PAIR_CHUNK_SIZE):
+        chunk_counts = counts[start:end]
+        total = int(chunk_counts.sum())
+        offsets = np.cumsum(chunk_counts) - chunk_counts
+        i = buy_keep[start:end].repeat(chunk_counts)
+        j = sell_keep[np.arange(total) - offsets.repeat(chunk_counts)]
+
+        b = buy_price[i]
+        s = sell_price[j]
+        margin = ((b / s) - 1)*100
+        max_items_could_be_transacted = np.minimum(sell_volume[j], buy_volume[i])
+        potential_revenue = (max_items_could_be_transacted*b) - (max_items_could_be_transacted*s)
+        keep = (b > s) & (margin >= min_margin) & (potential_revenue >= min_potential_revenue)
+        results.append((i[keep], j[keep], margin[keep], potential_revenue[keep]))
+
+    if len(results) == 0:
+        return _empty_result()
+
+    buy_idx, sell_idx, margins, revenues = [np.concatenate(r) for r in zip(*results)]
+    metrics.increment("scan.pairs_emitted", len(buy_idx))
+    # Emit pairs in the same order as the nested loop would
+    order = np.lexsort((sell_idx, buy_idx))
+    return buy_idx[order], sell_idx[order], margins[order], revenues[order]
+
+
+def scan_item_depth(buy, sell, buy_sec, sell_sec, min_margin, max_item_purchase_price, min_potential_revenue, min_system_sec_rating):
+    # One opportunity per (sell order location, buy order location), matched like an exchange would: cheapest sells
+    # against the highest buys until the margin runs out. Each order's volume is only used once within a location pair
+    buy_price = np.asarray(buy["price"], dtype=np.float64)
+    sell_price = np.asarray(sell["price"], dtype=np.float64)
+    buy_volume = np.asarray(buy["volume_remain"], dtype=np.int64)
+    sell_volume = np.asarray(sell["volume_remain"], dtype=np.int64)
+    buy_min_volume = np.asarray(buy["min_volume"], dtype=np.int64)
+    buy_location = np.asarray(buy["location_id"], dtype=np.int64)
+    sell_location = np.asarray(sell["location_id"], dtype=np.int64)
+
+    buy_keep = np.flatnonzero(np.asarray(buy_sec, dtype=np.float64) >= min_system_sec_rating)
+    sell_keep = np.flatnonzero(
+        (sell_price <= max_item_purchase_price) &
+        (np.asarray(sell_sec, dtype=np.float64) >= min_system_sec_rating)
+    )
+    if len(buy_keep) == 0 or len(sell_keep) == 0:
+        return _empty_depth_result()
+
+    # Ladders per location: sells cheapest first, buys highest first
+    sell_keep = sell_keep[np.lexsort((sell_price[sell_keep], sell_location[sell_keep]))]
+    buy_keep = buy_keep[np.lexsort((-buy_price[buy_keep], buy_location[buy_keep]))]
+    sell_locations, sell_starts = np.unique(sell_location[sell_keep], return_index=True)
+    buy_locations, buy_starts = np.unique(buy_location[buy_keep], return_index=True)
+    sell_ends = np.append(sell_starts[1:], len(sell_keep))
+    buy_ends = np.append(buy_starts[1:], len(buy_keep))
+
+    # Only location pairs where the best buy beats the best sell by the margin can trade at all
+    best_sell = sell_price[sell_keep[sell_starts]]
+    best_buy = buy_price[buy_keep[buy_starts]]
+    best_margin = ((best_buy[np.newaxis, :] / best_sell[:, np.newaxis]) - 1)*100
+    crossing = (best_buy[np.newaxis, :] > best_sell[:, np.newaxis]) & (best_margin >= min_margin)
+    metrics.increment("scan.location_pairs_possible", crossing.size)
+    metrics.increment("scan.location_pairs_checked", int(crossing.sum()))
+
+    results = []
+    for a, b in zip(*np.nonzero(crossing)):
+        sells = sell_keep[sell_starts[a]:sell_ends[a]]
+        buys = buy_keep[buy_starts[b]:buy_ends[b]]
+        match = _match_ladders(buy_price[buys], buy_volume[buys], buy_min_volume[buys], sell_price[sells], sell_volume[sells], min_margin)
+        if match is None:
+            continue
+        quantity, cost, revenue, first_buy, first_sell, num_buys, num_sells = match
+        if revenue - cost >= min_potential_revenue:
+            results.append((buys[first_buy], sells[first_sell], quantity, cost, revenue, num_buys, num_sells))
+
+    if len(results) == 0:
+        return _empty_depth_result()
+    metrics.increment("scan.location_pairs_emitted", len(results))
+    buy_idx, sell_idx, quantities, costs, revenues, num_buys, num_sells = [np.array(r) for r in zip(*results)]
+    return buy_idx, sell_idx, quantities, costs, revenues, num_buys, num_sells
+
+
+def _match_ladders(buy_price, buy_volume, buy_min_volume, sell_price, sell_volume, min_margin):
+    # Sell orders in EVE always have a min_volume of 1, so only the buy orders' minimums need respecting
+    cum_sell_volume = np.concatenate(([0], np.cumsum(sell_volume)))
+    quantity = 0
+    cost = 0.0
+    revenue = 0.0
+    first_buy = first_sell = None
+    num_buys = 0
+    j = 0
+    sell_left = int(sell_volume[0])
+    for i in range(len(buy_price)):
+        b = buy_price[i]
+        # Sells from j onwards that are still worth selling into this buy order
+        k = j
+        while k < len(sell_price) and b > sell_price[k] and ((b / sell_price[k]) - 1)*100 >= min_margin:
+            k += 1
+        if k == j:
+            break
+        available = int(cum_sell_volume[k] - cum_sell_volume[j + 1]) + sell_left
+        if available < buy_min_volume[i]:
+            continue
+
+        want = int(min(buy_volume[i], available))
+        if first_buy is None:
+            first_buy, first_sell = i, j
+        num_buys += 1
+        while want > 0:
+            take = min(want, sell_left)
+            quantity += take
+            cost += take*sell_price[j]
+            revenue += take*b
+            want -= take
+            sell_left -= take
+            if sell_left == 0:
+                j += 1
+                if j == len(sell_price):
+                    break
+                sell_left = int(sell_volume[j])
+        if j == len(sell_price):
+            break
+
+    if quantity == 0:
+        return None
+    num_sells = j + (1 if j < len(sell_price) and sell_left < sell_volume[j] else 0)
+    return quantity, cost, revenue, first_buy, first_sell, num_buys, num_sells
+
+
+def _chunk_bounds(counts, chunk_size):
+    cumulative = np.cumsum(counts)
+    cuts = np.searchsorted(cumulative, np.arange(chunk_size, cumulative[-1], chunk_size), side="right")
+    edges = np.unique(np.concatenate(([0], cuts, [len(counts)])))
+    return zip(edges[:-1], edges[1:])
+
+
+def _empty_result():
+    return (
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.float64),
+        np.empty(0, dtype=np.float64)
+    )
+
+
+def _empty_depth_result():
+    return (
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.float64),
+        np.empty(0, dtype=np.float64),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64)
+    )
@@ -1,9 +1,28 @@
 import json
 import sys
-import requests
 import csv
 import os
+import marshal
 import argparse
+import time
+import threading
+import metrics
+from multiprocessing.pool import ThreadPool
+
+ESI_URL = os.environ.get("EVEA_ESI_URL", "https://esi.evetech.net/latest")
+DEFAULT_CONCURRENCY = 20
+REQUEST_TIMEOUT = 60
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+# When streaming pages, at most this many pages per request slot are downloaded ahead of the one being processed
+STREAM_WINDOW = 4
+
+# Progress saved by an interrupted batched POST is only picked up again if it's newer than this
+CHECKPOINT_MAX_AGE = 24*60*60
+
+_session = None
+_session_lock = threading.Lock()
 
 def write_to_json(data, file):
     overwrite_print("<< Writing " + file + " to JSON\n")
@@ -11,16 +30,19 @@ def write_to_json(data, file):
         json.dump(data, f)
 
 
-def write_to_csv(header, rows, file, d=True):
+def write_to_csv(header, rows, file, d=True, append=False):
     overwrite_print("<< Writing " + file + " to CSV")
 
-    with open(file, "w") as f:
+    write_header = not (append and os.path.isfile(file))
+    with open(file, "a" if append else "w") as f:
         if d:
             cw = csv.DictWriter(f,header,delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            cw.writeheader()
+            if write_header:
+                cw.writeheader()
         else:
             cw = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            cw.writerow(header)
+            if write_header:
+                cw.writerow(header)
         cw.writerows(rows)
 
 
@@ -34,71 +56,241 @@ def overwrite_print(s):
 def load_data(fileloc):
     overwrite_print(">> Loading " + fileloc)
     try:
-        with open(fileloc) as f:
+        with open(fileloc) as f, metrics.timer("json.load"):
             return json.load(f)
     except IOError:
         print(" - No such file")
         return {}
 
 
-def download_data(url, request_type="get", post_data=None, paged=False, post_in_batches=False, batch_size=None):
+def load_compiled(fileloc, build, name="compiled", complete=None):
+    # What build() makes from fileloc is saved next to it with marshal, tagged with the file's size and modified time.
+    # Loading that back is far quicker than parsing the JSON again, and it's rebuilt whenever the file changes.
+    # If complete(data) says something build() needed was missing, nothing is saved, so the next call builds it again
+    compiled_fileloc = fileloc + "." + name + ".py" + str(sys.version_info[0]) + ".marshal"
+    try:
+        stat = os.stat(fileloc)
+    except OSError:
+        return build()
+    source = [stat.st_size, stat.st_mtime]
+    try:
+        with open(compiled_fileloc, "rb") as f:
+            compiled_source, data = marshal.load(f)
+        if compiled_source == source:
+            return data
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    data = build()
+    if complete is not None and not complete(data):
+        return data
+    try:
+        with open(compiled_fileloc + ".tmp", "wb") as f:
+            marshal.dump((source, data), f)
+        os.rename(compiled_fileloc + ".tmp", compiled_fileloc)
+    except (IOError, OSError, ValueError):
+        pass
+    return data
+
+
+def get_session(concurrency=DEFAULT_CONCURRENCY):
+    # requests takes longer to import than everything else put together, so it's only loaded once something is downloaded
+    import requests
+    global _session
+    with _session_lock:
+        if _session is None or _session.pool_size < concurrency:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.pool_size = concurrency
+            _session = session
+    return _session
+
+
+def request_with_retries(method, url, data=None, concurrency=DEFAULT_CONCURRENCY, headers=None):
+    import requests
+    session = get_session(concurrency)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with metrics.timer("http.request"):
+                r = session.request(method, url, data=data, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException:
+            metrics.increment("http.errors")
+            if attempt == MAX_RETRIES:
+                raise
+            metrics.increment("http.retries")
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+            continue
+        metrics.increment("http.bytes", len(r.content))
+        metrics.increment("http.status." + str(r.status_code))
+
+        # 5xx is usually transient. 420 means we've hit ESI's error limit and need to wait for it to reset
+        if (r.status_code < 500 and r.status_code != 420) or attempt == MAX_RETRIES:
+            return r
+        wait = RETRY_BACKOFF * 2**attempt
+        if r.status_code == 420:
+            wait = max(wait, float(r.headers.get("X-Esi-Error-Limit-Reset", wait)))
+        print("\nGot " + str(r.status_code) + " from " + url + ". Retrying in " + str(wait) + "s")
+        metrics.increment("http.retries")
+        time.sleep(wait)
+
+
+def parse_http_date(value):
+    import email.utils
+    if value is None:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def download_page(url, page, concurrency=DEFAULT_CONCURRENCY, etag=None):
+    headers = {"If-None-Match": etag} if etag is not None else None
+    r = request_with_retries("get", url + "&page=" + str(page), concurrency=concurrency, headers=headers)
+    num_pages = r.headers.get("X-Pages")
+    num_pages = int(num_pages) if num_pages is not None else None
+    expires = parse_http_date(r.headers.get("Expires"))
+    if r.status_code == 304:
+        # Unchanged since we last saw it. The caller reuses the copy it already has
+        return None, num_pages, etag, expires
+    try:
+        with metrics.timer("json.parse"):
+            page_data = r.json()
+    except ValueError:
+        print("Error! ValueError when trying to extract JSON")
+        print("Here's the response: " + r.text)
+        return [], num_pages, None, expires
+    if not isinstance(page_data, list):
+        print("Error! Unexpected page response: " + str(page_data))
+        return [], num_pages, None, expires
+    return page_data, num_pages, r.headers.get("ETag"), expires
+
+
+def load_page_meta(fileloc):
+    try:
+        with open(fileloc + ".meta") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_page_meta(fileloc, meta):
+    with open(fileloc + ".meta", "w") as f:
+        json.dump(meta, f)
+
+
+def download_many(urls, concurrency=DEFAULT_CONCURRENCY):
+    def fetch(url):
+        r = request_with_retries("get", url, concurrency=concurrency)
+        try:
+            return r.json()
+        except ValueError:
+            print("Error! ValueError when trying to extract JSON")
+            print("Here's the response: " + r.text)
+            return None
+
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        data = []
+        for n, url_data in enumerate(pool.imap(fetch, urls)):
+            overwrite_print("------> Downloaded " + str(n + 1) + "/" + str(len(urls)))
+            data.append(url_data)
+    finally:
+        pool.close()
+        pool.join()
+    return data
+
+
+class BatchFailed(Exception):
+    pass
+
+
+def post_batch(url, batch, concurrency=DEFAULT_CONCURRENCY):
+    # Returns (data, rejected ids). A batch ESI refuses is split in half and each half tried again, down to single ids.
+    # Server errors that outlast request_with_retries raise BatchFailed instead, so the run stops and can resume later
+    r = request_with_retries("post", url, concurrency=concurrency, data=json.dumps(batch))
+    if r.status_code >= 500 or r.status_code == 420:
+        raise BatchFailed("Got " + str(r.status_code) + " from " + url + " after retrying")
+    if r.status_code == 200:
+        try:
+            return r.json(), []
+        except ValueError:
+            print("Error! ValueError when trying to extract JSON")
+            print("Here's the response: " + r.text)
+    if len(batch) == 1:
+        print("\nError! " + url + " rejected " + str(batch[0]) + " with " + str(r.status_code) + ". Skipping it")
+        return [], batch
+    data_1, rejected_1 = post_batch(url, batch[:len(batch)//2], concurrency)
+    data_2, rejected_2 = post_batch(url, batch[len(batch)//2:], concurrency)
+    return data_1 + data_2, rejected_1 + rejected_2
+
+
+def load_checkpoint(fileloc):
+    # Batches finished by an earlier run, one per line. A line cut off by the run dying is ignored
+    done = []
+    if fileloc is None or not os.path.isfile(fileloc) or time.time() - os.path.getmtime(fileloc) > CHECKPOINT_MAX_AGE:
+        return done
+    with open(fileloc) as f:
+        for line in f:
+            try:
+                done.append(json.loads(line))
+            except ValueError:
+                break
+    return done
+
+
+def post_batches(url, post_data, batch_size, concurrency=DEFAULT_CONCURRENCY, checkpoint_fileloc=None):
+    # Up to concurrency batches are in flight at once. Each finished batch is appended to checkpoint_fileloc,
+    # so if the run dies only the batches that hadn't finished are posted again
+    done = load_checkpoint(checkpoint_fileloc)
+    finished_ids = set([post_id for batch in done for post_id in batch["ids"]])
+    remaining = [post_id for post_id in post_data if post_id not in finished_ids]
+    batches = [remaining[start:start + batch_size] for start in range(0, len(remaining), batch_size)]
+    print("------> Posting " + str(len(remaining)) + " rows of post data in " + str(len(batches)) + " batches. " + str(len(post_data) - len(remaining)) + " already done")
+
+    data = [item for batch in done for item in batch["data"]]
+    num_rejected = len([post_id for batch in done for post_id in batch["rejected"]])
+    checkpoint = open(checkpoint_fileloc, "a") if checkpoint_fileloc is not None else None
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        # Saved in whatever order they finish, so one slow batch doesn't hold back the checkpoint
+        for n, (batch, (batch_data, rejected)) in enumerate(pool.imap_unordered(lambda batch: (batch, post_batch(url, batch, concurrency)), batches)):
+            overwrite_print("\t---> Posted batch " + str(n + 1) + "/" + str(len(batches)))
+            data += batch_data
+            num_rejected += len(rejected)
+            if checkpoint is not None:
+                checkpoint.write(json.dumps({"ids": batch, "data": batch_data, "rejected": rejected}) + "\n")
+                checkpoint.flush()
+        pool.close()
+    except BaseException:
+        # Don't post the batches still queued. They'll be picked up when the run is resumed
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if checkpoint is not None:
+            checkpoint.close()
+    if num_rejected > 0:
+        print("\n" + str(num_rejected) + " ids were rejected and skipped")
+    return data
+
+
+def download_data(url, request_type="get", post_data=None, post_in_batches=False, batch_size=None, concurrency=DEFAULT_CONCURRENCY, checkpoint_fileloc=None):
     print("\n<< Downloading from: " + url)
     data = []
     if request_type == "get":
-        if paged:
-            for page in [i + 1 for i in range(999999)]:
-                overwrite_print("------> Working on page " + str(page))
-                page_url = url + "&page=" + str(page)
-                r = requests.get(page_url)
-                try:
-                    page_data = r.json()
-                    if len(page_data) > 0:
-                        data += page_data
-                    else:
-                        break
-                except ValueError:
-                    print("Error! ValueError when trying to extract JSON")
-                    print("Here's the response: " + r.text)
-                    continue
-        else:
-            r = requests.get(url)
-            try:
-                data = r.json()
-            except ValueError:
-                print("Error! ValueError when trying to extract JSON")
-                print("Here's the response: " + r.text)
+        r = request_with_retries("get", url, concurrency=concurrency)
+        try:
+            data = r.json()
+        except ValueError:
+            print("Error! ValueError when trying to extract JSON")
+            print("Here's the response: " + r.text)
     elif request_type == "post":
         if post_in_batches:
-            post_data_length = len(post_data)
-            data = []
-            print("------> Iterating over " + str(post_data_length) + " rows of post data")
-
-            for iteration in range(post_data_length / batch_size):
-                overwrite_print("\t---> Batch is: " + str(iteration*batch_size) + " to " + str(((iteration+1)*batch_size)-1))
-                r = requests.post(url, data=json.dumps(post_data[iteration*batch_size: (iteration+1)*batch_size]))
-                try:
-                    iteration_data = r.json()
-                    if len(iteration_data) > 0:
-                        data += iteration_data
-                    else:
-                        continue
-                except ValueError:
-                    print("Error! ValueError when trying to extract JSON")
-                    print("Here's the response: " + r.text)
-                    continue
-
-            if post_data_length % batch_size > 0:
-                overwrite_print("---> Batch is: " + str(batch_size*(post_data_length / batch_size)) + " to " + str((batch_size*(post_data_length / batch_size) + (post_data_length % batch_size))-1))
-                r = requests.post(url, data=json.dumps(post_data[batch_size*(post_data_length / batch_size): batch_size*(post_data_length / batch_size) + (post_data_length % batch_size)]))
-                try:
-                    iteration_data = r.json()
-                    if len(iteration_data) > 0:
-                        data += iteration_data
-                except ValueError:
-                    print("Error! ValueError when trying to extract JSON")
-                    print("Here's the response: " + r.text)
+            data = post_batches(url, post_data, batch_size, concurrency, checkpoint_fileloc)
         else:
-            r = requests.post(url, data=json.dumps(post_data))
+            r = request_with_retries("post", url, concurrency=concurrency, data=json.dumps(post_data))
             try:
                 data = r.json()
             except ValueError:
@@ -110,7 +302,10 @@ def download_data(url, request_type="get", post_data=None, paged=False, post_in_
     return data
 
 
-def get_data(url, fileloc, request_type="get", post_data=None, paged=False, post_in_batches=False, batch_size=None, force=False):
+def get_data(url, fileloc, request_type="get", post_data=None, paged=False, post_in_batches=False, batch_size=None, force=False, concurrency=DEFAULT_CONCURRENCY):
+    if paged and request_type == "get":
+        return get_paged_data(url, fileloc, force, concurrency)
+
     if force == False:
         try:
             data = load_data(fileloc)
@@ -120,13 +315,168 @@ def get_data(url, fileloc, request_type="get", post_data=None, paged=False, post
             pass
 
     # Force = True or no data at fileloc
+    checkpoint_fileloc = fileloc + ".partial" if post_in_batches else None
     data = download_data(
-        url, request_type, post_data, paged, post_in_batches, batch_size
+        url, request_type, post_data, post_in_batches, batch_size, concurrency, checkpoint_fileloc
     )
     write_to_json(data, fileloc)
+    if checkpoint_fileloc is not None and os.path.isfile(checkpoint_fileloc):
+        os.remove(checkpoint_fileloc)
+    return data
+
+
+def get_paged_data(url, fileloc, force=False, concurrency=DEFAULT_CONCURRENCY):
+    # Fetched and saved page by page like the orders, just joined into one list
+    data = []
+    changed_by_url, streamed_by_url = stream_paged_data_many([url], [fileloc], lambda k, page_data: data.extend(page_data), force, concurrency)
+    if not streamed_by_url[0]:
+        for page_data in read_pages(fileloc):
+            data += page_data
     return data
 
 
+def stream_paged_data_many(urls, filelocs, on_page, force=False, concurrency=DEFAULT_CONCURRENCY):
+    # Pages are handed to on_page(k, page_data) one at a time, in order, instead of being joined in memory. Saved one
+    # JSON array per page per line so pages that come back 304 can be read back one at a time.
+    # Returns which urls changed, and which were streamed (the rest are still in their cache window and were left alone)
+    metas = [load_page_meta(fileloc) for fileloc in filelocs]
+    metas = [meta if meta is not None and meta.get("format") == "pages" else None for meta in metas]
+    changed_by_url = [False]*len(urls)
+    streamed_by_url = [False]*len(urls)
+
+    now = time.time()
+    due = []
+    for k, fileloc in enumerate(filelocs):
+        if not os.path.isfile(fileloc):
+            metas[k] = None
+            due.append(k)
+        elif force and not (metas[k] is not None and metas[k]["expires"] > now):
+            # Anything still inside its ESI cache window can't have changed, so there's no need to ask
+            due.append(k)
+    if len(due) == 0:
+        return changed_by_url, streamed_by_url
+
+    def fetch(job):
+        k, page = job
+        known_pages = metas[k]["pages"] if metas[k] is not None else []
+        etag = known_pages[page - 1]["etag"] if page <= len(known_pages) else None
+        return download_page(urls[k], page, concurrency, etag)
+
+    # The job generator blocks once it's this far ahead of the pages that have been processed
+    window = threading.Semaphore(max(1, concurrency)*STREAM_WINDOW)
+    stopped = []
+
+    def throttled(jobs):
+        for job in jobs:
+            window.acquire()
+            if len(stopped) > 0:
+                return
+            yield job
+
+    print("\n<< Streaming " + str(len(due)) + " paged urls, " + str(concurrency) + " requests at a time")
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        first_pages = pool.map(fetch, [(k, 1) for k in due])
+        jobs = []
+        for k, first_page in zip(due, first_pages):
+            jobs += [(k, page) for page in range(1, (first_page[1] or 1) + 1)]
+        first_page_by_url = dict(zip(due, first_pages))
+        rest = pool.imap(fetch, throttled([job for job in jobs if job[1] > 1]))
+
+        for n, (k, page) in enumerate(jobs):
+            if page == 1:
+                result = first_page_by_url.pop(k)
+                writer = _PagedFileWriter(urls[k], filelocs[k], metas[k], result[1])
+                num_pages = result[1]
+            else:
+                result = next(rest)
+                window.release()
+            overwrite_print("------> Streamed page " + str(n + 1) + "/" + str(len(jobs)))
+            on_page(k, writer.add(result))
+            if page == (num_pages or 1):
+                if num_pages is None:
+                    # No X-Pages header. Walk pages until we get an empty one
+                    for page_data in _pages_until_empty(urls[k], concurrency):
+                        on_page(k, writer.add((page_data, None, None, None)))
+                changed_by_url[k] = writer.close()
+                streamed_by_url[k] = True
+    except BaseException:
+        stopped.append(True)
+        window.release()
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    print("\n" + str(sum(changed_by_url)) + "/" + str(len(due)) + " paged urls had changed")
+    return changed_by_url, streamed_by_url
+
+
+def _pages_until_empty(url, concurrency=DEFAULT_CONCURRENCY):
+    page = 2
+    page_data = download_page(url, page, concurrency)[0]
+    while isinstance(page_data, list) and len(page_data) > 0:
+        yield page_data
+        page += 1
+        page_data = download_page(url, page, concurrency)[0]
+
+
+class _PagedFileWriter(object):
+
+    def __init__(self, url, fileloc, meta, num_pages):
+        self.url = url
+        self.fileloc = fileloc
+        self.meta = meta
+        known_pages = meta["pages"] if meta is not None else []
+        self.changed = meta is None or num_pages is None or len(known_pages) != num_pages
+        self.old_pages = open(fileloc) if meta is not None else None
+        self.new_file = open(fileloc + ".tmp", "w")
+        self.new_pages = []
+        self.expires = []
+
+    def add(self, result):
+        page_data, _, etag, expires = result
+        old_line = self.old_pages.readline() if self.old_pages is not None else ""
+        if page_data is None:
+            # 304. Unchanged since last time, so it's the same line in the copy we already have
+            page_data = json.loads(old_line)
+            metrics.increment("pages.reused")
+        else:
+            self.changed = True
+            metrics.increment("pages.downloaded")
+        self.new_file.write(json.dumps(page_data) + "\n")
+        self.new_pages.append({"etag": etag, "count": len(page_data)})
+        self.expires.append(expires)
+        return page_data
+
+    def close(self):
+        self.new_file.close()
+        if self.old_pages is not None:
+            self.old_pages.close()
+        expires = [e for e in self.expires if e is not None]
+        expires = min(expires) if len(expires) > 0 else time.time()
+        if not self.changed:
+            os.remove(self.fileloc + ".tmp")
+            self.meta["expires"] = expires
+            write_page_meta(self.fileloc, self.meta)
+            return False
+        if os.path.isfile(self.fileloc):
+            os.remove(self.fileloc)
+        os.rename(self.fileloc + ".tmp", self.fileloc)
+        write_page_meta(self.fileloc, {"url": self.url, "expires": expires, "format": "pages", "pages": self.new_pages})
+        return True
+
+
+def read_pages(fileloc):
+    # Pages saved by stream_paged_data_many, one at a time. Files saved as one JSON list come back as a single page
+    meta = load_page_meta(fileloc)
+    if meta is not None and meta.get("format") == "pages":
+        with open(fileloc) as f:
+            for line in f:
+                yield json.loads(line)
+    else:
+        yield load_data(fileloc)
+
+
 def directories_exist():
     level_1 = ["data", "output"]
     level_2_data = ["orders", "regions", "routes", "systems", "types"]
@@ -141,24 +491,24 @@ def directories_exist():
 
 
 def create_folder_structure():
-    print "Creating file structure"
+    print("Creating file structure")
     level_1 = ["data", "output"]
     level_2_data = ["orders", "regions", "routes", "systems", "types"]
     for l1 in level_1:
         if os.path.isdir("./" + l1) == False:
-            os.mkdir("./" + l1, 0777)
+            os.mkdir("./" + l1, 0o777)
             if l1 == "data":
                 for l2 in level_2_data:
                     if os.path.isdir("./" + l1 + "/" + l2) == False:
-                        os.mkdir("./" + l1 + "/" + l2, 0777)
+                        os.mkdir("./" + l1 + "/" + l2, 0o777)
 
 
-    print "Done. Created:"
+    print("Done. Created:")
     for l1 in level_1:
-        print "./" + l1
+        print("./" + l1)
         if l1 == "data":
             for l2 in level_2_data:
-                print "--> ./" + l1 + "/" + l2
+                print("--> ./" + l1 + "/" + l2)
 
 
 def str2bool(v):